@@ -0,0 +1,77 @@
+"""BPR training step of IncBertAttBpr: separate forward passes for positives and negatives vs one fused forward_pair
+
+run from the repo root, e.g.:
+    python -m benchmarks.bench_bpr_forward --bert=bert-base-chinese --batches 16 64
+"""
+import argparse
+import time
+
+import torch
+
+from model_temps.incbertbpr import IncBertAttBpr
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batches', type=int, nargs='+', default=[16, 64], help="bpr pairs per batch to measure", required=False)
+parser.add_argument('--pad_len', type=int, default=32, help="maximum padding length for a sentence", required=False)
+parser.add_argument('--bert', type=str, default='Langboat/mengzi-bert-base-fin', help="version of bert", required=False)
+parser.add_argument('--steps', type=int, default=10, help="training steps per measurement", required=False)
+parser.add_argument('--repeats', type=int, default=3, help="alternating measurements per path, the best one is reported", required=False)
+parser.add_argument('--device', type=str, default='cpu', help="computing device", required=False)
+args = parser.parse_args()
+
+post_unique, author_unique = [13, 20, 80, 3, 30], [2, 2, 2, 50, 50, 50]
+model = IncBertAttBpr(dim=64,
+                      post_ft_unique_count=post_unique,
+                      author_ft_unique_count=author_unique,
+                      post_ft_count=len(post_unique),
+                      author_ft_count=len(author_unique),
+                      device=args.device,
+                      drop_rate=0.1,
+                      bert=args.bert).to(args.device)
+optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+
+
+def random_batch(batch, gen):
+    # titles of random length, as trimmed batches: positives and negatives padded to different lengths
+    lengths = torch.randint(4, args.pad_len+1, (batch,), generator=gen)
+    text = torch.zeros((batch, 2, int(lengths.max())), dtype=torch.int32)
+    for i, n in enumerate(lengths.tolist()):
+        text[i, 0, :n] = torch.randint(1, model.tokenizer.vocab_size, (n,), generator=gen)
+        text[i, 1, :n] = 1
+    post = torch.stack([torch.randint(0, n, (batch,), generator=gen) for n in post_unique], dim=1).to(torch.int8)
+    author = torch.stack([torch.randint(0, n, (batch,), generator=gen) for n in author_unique], dim=1).to(torch.int8)
+    return text, post, author
+
+
+def separate(pos_data, neg_data):
+    pos_scores = model(*(x.to(args.device) for x in pos_data))[0]
+    neg_scores = model(*(x.to(args.device) for x in neg_data))[0]
+    return pos_scores, neg_scores
+
+
+def steps_per_sec(pair_scores, batches):
+    torch.nn.Module.train(model, True) # the model's own train/eval are its training step and evaluation
+    time_s = time.perf_counter()
+    for pos_data, neg_data in batches:
+        loss = model.compute_loss(*pair_scores(pos_data, neg_data))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return len(batches) / (time.perf_counter()-time_s)
+
+
+gen = torch.Generator().manual_seed(666)
+for batch in args.batches:
+    batches = [(random_batch(batch, gen), random_batch(batch, gen)) for _ in range(args.steps)]
+
+    # same scores either way (dropout off)
+    torch.nn.Module.train(model, False)
+    with torch.no_grad():
+        diff = max(max((a-b).abs().max().item() for a, b in zip(separate(*x), model.forward_pair(*x))) for x in batches)
+
+    steps_per_sec(model.forward_pair, batches[:1]) # warm up
+    two_pass, fused = 0, 0
+    for _ in range(args.repeats):
+        two_pass = max(two_pass, steps_per_sec(separate, batches))
+        fused = max(fused, steps_per_sec(model.forward_pair, batches))
+    print(f"batch {batch}: separate {two_pass:.2f} steps/s; fused {fused:.2f} steps/s; speedup {fused/two_pass:.2f}x; max score diff {diff:.2e}")
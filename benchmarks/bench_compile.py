@@ -0,0 +1,83 @@
+"""IncBertAttBpr training steps, eager vs compiled forward (main.py --compile): compile time and steady-state steps/sec
+
+run from the repo root, e.g.:
+    python -m benchmarks.bench_compile --bert=bert-base-chinese
+a second run with the same --compile_cache shows the cached compile time
+"""
+import argparse
+import time
+
+import torch
+
+from model_temps.incbertbpr import IncBertAttBpr
+from model_temps.compiled import CACHE_DIR, compile_forward
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch', type=int, default=64, help="bpr pairs per batch", required=False)
+parser.add_argument('--pad_len', type=int, default=32, help="maximum padding length for a sentence", required=False)
+parser.add_argument('--bert', type=str, default='Langboat/mengzi-bert-base-fin', help="version of bert", required=False)
+parser.add_argument('--steps', type=int, default=10, help="training steps per measurement", required=False)
+parser.add_argument('--repeats', type=int, default=3, help="measurements per path, the best one is reported", required=False)
+parser.add_argument('--compile_cache', type=str, default=CACHE_DIR, help="directory of the compiled graph and kernel caches", required=False)
+parser.add_argument('--device', type=str, default='cpu', help="computing device", required=False)
+args = parser.parse_args()
+
+post_unique, author_unique = [13, 20, 80, 3, 30], [2, 2, 2, 50, 50, 50]
+
+
+def make_model():
+    torch.manual_seed(666)
+    model = IncBertAttBpr(dim=64,
+                          post_ft_unique_count=post_unique,
+                          author_ft_unique_count=author_unique,
+                          post_ft_count=len(post_unique),
+                          author_ft_count=len(author_unique),
+                          device=args.device,
+                          drop_rate=0.1,
+                          bert=args.bert).to(args.device)
+    return model, torch.optim.AdamW(model.parameters(), lr=1e-5)
+
+
+def random_batch(batch, gen):
+    # titles of random length, as trimmed batches
+    lengths = torch.randint(4, args.pad_len+1, (batch,), generator=gen)
+    text = torch.zeros((batch, 2, int(lengths.max())), dtype=torch.int32)
+    for i, n in enumerate(lengths.tolist()):
+        text[i, 0, :n] = torch.randint(1, model.tokenizer.vocab_size, (n,), generator=gen)
+        text[i, 1, :n] = 1
+    post = torch.stack([torch.randint(0, n, (batch,), generator=gen) for n in post_unique], dim=1).to(torch.int8)
+    author = torch.stack([torch.randint(0, n, (batch,), generator=gen) for n in author_unique], dim=1).to(torch.int8)
+    return text, post, author
+
+
+def run(model, optimizer, batches):
+    torch.nn.Module.train(model, True) # the model's own train/eval are its training step and evaluation
+    time_s = time.perf_counter()
+    for batch_data in batches:
+        loss = model.train(batch_data)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return time.perf_counter()-time_s
+
+
+models = {'eager': make_model(), 'compiled': make_model()}
+compile_forward(models['compiled'][0], args.compile_cache)
+model = models['eager'][0]
+
+gen = torch.Generator().manual_seed(666)
+batches = [(random_batch(args.batch, gen), random_batch(args.batch, gen)) for _ in range(args.steps)]
+# an epoch's last partial batch
+partial = (random_batch(args.batch//2+1, gen), random_batch(args.batch//2+1, gen))
+
+# first pass over every shape: compiles (or loads from the cache) the full-batch and partial-batch graphs
+for name in models:
+    print(f"{name}: first pass {run(*models[name], batches+[partial]):.1f}s")
+
+result = {name: 0 for name in models}
+for _ in range(args.repeats): # alternating, best of
+    for name in models:
+        result[name] = max(result[name], args.steps/run(*models[name], batches))
+for name in models:
+    print(f"{name}: steady state {result[name]:.2f} steps/s")
+print(f"speedup {result['compiled']/result['eager']:.2f}x")
@@ -0,0 +1,98 @@
+"""DataLoader throughput for IncBprData: the original pandas iloc loader (baseline), per-item __getitem__ on the
+tensor columns + default_collate, and batched __getitems__
+
+run from the repo root, e.g.:
+    python -m benchmarks.bench_loader --data_dir=./data/train_bpr1.csv --batches 64 1024
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from dataset.inc_bprdata import IncBprData
+from dataset.transform import ToTensor, batch_collate
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_dir', type=str, default='./data/train_bpr1.csv', help="bpr csv to load", required=False)
+parser.add_argument('--batches', type=int, nargs='+', default=[64, 1024], help="batch sizes to measure", required=False)
+parser.add_argument('--pad_len', type=int, default=32, help="maximum padding length for a sentence", required=False)
+parser.add_argument('--bert', type=str, default='Langboat/mengzi-bert-base-fin', help="version of bert", required=False)
+parser.add_argument('--max_batches', type=int, default=200, help="batches per measurement", required=False)
+parser.add_argument('--baseline_batches', type=int, default=20, help="batches per measurement of the (slow) pandas baseline", required=False)
+args = parser.parse_args()
+
+
+# hides __getitems__ so the DataLoader falls back to one __getitem__ call per sample
+class PerItem(Dataset):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return self.dataset[idx]
+
+
+# the loader before the tensor columns: the denormalized bpr frame kept in pandas, title ids/masks one array per cell,
+# every sample an iloc row converted to tensors (as the original IncBprData.__getitem__; Series go through to_numpy,
+# which torch.tensor needs on current versions)
+class PandasRows(Dataset):
+    def __init__(self, data, post_cols, author_cols):
+        self.post_cols, self.author_cols = post_cols, author_cols
+        text, post, author = (x.numpy() for x in data.posts)
+        pairs = data.pairs.long().numpy()
+        frame = {}
+        for prefix, idx in (('', pairs[:, 0]), ('neg_', pairs[:, 1])):
+            frame[prefix+'title_id'] = list(text[idx, 0])
+            frame[prefix+'title_mask'] = list(text[idx, 1])
+            frame.update({prefix+x: post[idx, i] for i, x in enumerate(post_cols)})
+            frame.update({prefix+x: author[idx, i] for i, x in enumerate(author_cols)})
+        self.data = pd.DataFrame(frame)
+
+    def __len__(self):
+        return len(self.data)
+
+    def sample(self, record, prefix):
+        text = torch.tensor(np.stack(record[[prefix+'title_id', prefix+'title_mask']].values))
+        post = torch.tensor(record[[prefix+x for x in self.post_cols]].astype(np.int8).to_numpy())
+        author = torch.tensor(record[[prefix+x for x in self.author_cols]].astype(np.int8).to_numpy())
+        return text, post, author
+
+    def __getitem__(self, idx):
+        record = self.data.iloc[idx]
+        return self.sample(record, ''), self.sample(record, 'neg_')
+
+
+def samples_per_sec(loader, max_batches):
+    n, time_s = 0, time.perf_counter()
+    for i, (pos_data, _) in enumerate(loader):
+        n += pos_data[0].shape[0]
+        if i+1 >= max_batches:
+            break
+    return n / (time.perf_counter()-time_s)
+
+
+post_cols = ['month', 'ind_code1_index', 'ind_code2_index', 'sentiment', 'topic']
+author_cols = ['eastmoney_robo_journalism', 'media_robo_journalism', 'SMA_robo_journalism',
+               'item_author_index_rank', 'article_author_index_rank', 'article_source_index_rank']
+data = IncBprData(data_dir=args.data_dir,
+                  post_cols=post_cols,
+                  author_cols=author_cols,
+                  max_padding_len=args.pad_len,
+                  x_transforms=[ToTensor()],
+                  bert=args.bert)
+
+baseline_data = PandasRows(data, post_cols, author_cols)
+
+torch.manual_seed(666)
+for batch in args.batches:
+    baseline = samples_per_sec(DataLoader(baseline_data, batch_size=batch, shuffle=True), args.baseline_batches)
+    per_item = samples_per_sec(DataLoader(PerItem(data), batch_size=batch, shuffle=True), args.max_batches)
+    batched = samples_per_sec(DataLoader(data, batch_size=batch, shuffle=True, collate_fn=batch_collate), args.max_batches)
+    print(f"batch {batch}: pandas baseline {baseline:.0f} samples/s; per-item tensors {per_item:.0f} samples/s "
+          f"({per_item/baseline:.1f}x); batched {batched:.0f} samples/s ({batched/baseline:.1f}x over the baseline, "
+          f"{batched/per_item:.1f}x over per-item)")
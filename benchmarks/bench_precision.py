@@ -0,0 +1,103 @@
+"""IncBertAttBpr under autocast (main.py --precision) vs fp32: training and scoring throughput, and score/loss deltas
+
+run from the repo root, e.g.:
+    python -m benchmarks.bench_precision --bert=bert-base-chinese --precisions bf16
+"""
+import argparse
+import time
+
+import torch
+
+from model_temps.incbertbpr import IncBertAttBpr
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch', type=int, default=64, help="bpr pairs per batch", required=False)
+parser.add_argument('--pad_len', type=int, default=32, help="maximum padding length for a sentence", required=False)
+parser.add_argument('--bert', type=str, default='Langboat/mengzi-bert-base-fin', help="version of bert", required=False)
+parser.add_argument('--precisions', type=str, nargs='+', default=['bf16'], choices=['bf16', 'fp16'], help="autocast precisions compared to fp32", required=False)
+parser.add_argument('--steps', type=int, default=10, help="batches per measurement", required=False)
+parser.add_argument('--repeats', type=int, default=3, help="alternating measurements per precision, the best one is reported", required=False)
+parser.add_argument('--device', type=str, default='cpu', help="computing device", required=False)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+dtypes = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+post_unique, author_unique = [13, 20, 80, 3, 30], [2, 2, 2, 50, 50, 50]
+model = IncBertAttBpr(dim=64,
+                      post_ft_unique_count=post_unique,
+                      author_ft_unique_count=author_unique,
+                      post_ft_count=len(post_unique),
+                      author_ft_count=len(author_unique),
+                      device=device,
+                      drop_rate=0.1,
+                      bert=args.bert).to(device)
+optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+
+
+def autocast(precision):
+    # as main.py
+    return torch.autocast(device_type=device.type, dtype=dtypes[precision], enabled=dtypes[precision] is not None)
+
+
+def random_batch(gen):
+    lengths = torch.randint(4, args.pad_len+1, (args.batch,), generator=gen)
+    text = torch.zeros((args.batch, 2, int(lengths.max())), dtype=torch.int32)
+    for i, n in enumerate(lengths.tolist()):
+        text[i, 0, :n] = torch.randint(1, model.tokenizer.vocab_size, (n,), generator=gen)
+        text[i, 1, :n] = 1
+    post = torch.stack([torch.randint(0, n, (args.batch,), generator=gen) for n in post_unique], dim=1).to(torch.int8)
+    author = torch.stack([torch.randint(0, n, (args.batch,), generator=gen) for n in author_unique], dim=1).to(torch.int8)
+    return text, post, author
+
+
+def train_steps_per_sec(precision, batches):
+    torch.nn.Module.train(model, True) # the model's own train/eval are its training step and evaluation
+    scaler = torch.amp.GradScaler(device.type, enabled=precision=='fp16')
+    time_s = time.perf_counter()
+    for batch_data in batches:
+        with autocast(precision):
+            loss = model.train(batch_data)
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+    return len(batches) / (time.perf_counter()-time_s)
+
+
+def score(precision, batches):
+    # eval-mode scores and bpr loss of every pair
+    torch.nn.Module.train(model, False)
+    with torch.no_grad(), autocast(precision):
+        pairs = [model.forward_pair(*batch_data) for batch_data in batches]
+    pos_scores = torch.cat([p for p, _ in pairs]).float()
+    neg_scores = torch.cat([n for _, n in pairs]).float()
+    return pos_scores, neg_scores, model.compute_loss(pos_scores, neg_scores).item()
+
+
+def score_steps_per_sec(precision, batches):
+    time_s = time.perf_counter()
+    score(precision, batches)
+    return len(batches) / (time.perf_counter()-time_s)
+
+
+gen = torch.Generator().manual_seed(666)
+batches = [(random_batch(gen), random_batch(gen)) for _ in range(args.steps)]
+
+# deltas on the same (untrained) weights
+ref_pos, ref_neg, ref_loss = score('fp32', batches)
+for precision in args.precisions:
+    pos, neg, loss = score(precision, batches)
+    diff = max((pos-ref_pos).abs().max().item(), (neg-ref_neg).abs().max().item())
+    agree = ((pos > neg) == (ref_pos > ref_neg)).float().mean().item()
+    print(f"{precision} vs fp32: max score diff {diff:.2e}; loss {loss:.5f} vs {ref_loss:.5f}; pair order agreement {agree:.4f}")
+
+train_steps_per_sec('fp32', batches[:1]) # warm up
+for precision in args.precisions:
+    train_steps_per_sec(precision, batches[:1])
+best = {p: [0, 0] for p in ['fp32']+args.precisions}
+for _ in range(args.repeats):
+    for precision in best:
+        best[precision][0] = max(best[precision][0], train_steps_per_sec(precision, batches))
+        best[precision][1] = max(best[precision][1], score_steps_per_sec(precision, batches))
+for precision, (train, scoring) in best.items():
+    print(f"{precision}: train {train:.2f} steps/s ({train/best['fp32'][0]:.2f}x); score {scoring:.2f} batches/s ({scoring/best['fp32'][1]:.2f}x)")
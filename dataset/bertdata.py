@@ -5,86 +5,72 @@ import torch
 torch.manual_seed(666)
 from torch.utils.data import Dataset
 
-from transformers import BertTokenizer
+from dataset.columnar import read_columns
+from dataset.metadata import load_metadata
+from dataset.tokencache import encode_titles
+from dataset.tensorstore import load_tensors, store_key, transform_names
+from dataset.transform import apply_transforms
 
 class BertData(Dataset):
-    def __init__(self, cat_cols=[], num_cols=[], topic_cols=[], tar_cols=[], max_padding_len=32, dir="./data/eastmoney_topic_bert.csv", x_transforms=None, y_transforms=None, bert='bert-base-chinese'):
+    def __init__(self, cat_cols=[], num_cols=[], topic_cols=[], tar_cols=[], max_padding_len=32, dir="./data/eastmoney_topic_bert.csv", x_transforms=None, y_transforms=None, bert='bert-base-chinese', nrows=64000):
 
-        #load data
-        self.data = pd.read_csv(dir,index_col=0, nrows=64000)
-        # print(self.data.columns)
-        # print(self.data.dtypes)
-
-        # #generate onehot encoding
-        # self.data = pd.get_dummies(self.data, columns=onehot_cols)
-
-        # process cat cols: generate embed index for embed cols
-        self.data[cat_cols] = self.data[cat_cols].apply(lambda c: c.astype('category'))
-        self.embed_cols = []
-        for cat_col in cat_cols:
-            self.data[f'{cat_col}_index'] = self.data[cat_col].cat.codes+1 #+1 for nan cases
-            self.embed_cols.append(f'{cat_col}_index')
-
-        # process text data: for bert input 
-        tokenizer = BertTokenizer.from_pretrained(bert)
-        input_ids = []
-        attention_masks = []
-        for text in self.data['item_title']:
-            encoded_dict = tokenizer.encode_plus(text,
-                                                add_special_tokens=True,
-                                                max_length=max_padding_len,
-                                                truncation=True,
-                                                padding='max_length',
-                                                return_attention_mask=True,
-                                                return_tensors='pt')
-            input_ids.append(np.array(encoded_dict['input_ids'].squeeze()))
-            attention_masks.append(np.array(encoded_dict['attention_mask'].squeeze()))
-            # print(text)
-            # print(encoded_dict['input_ids'])
-        self.data['title_id'] = input_ids
-        self.data['title_mask'] = attention_masks
-
-        self.text_cols=['title_id', 'title_mask']
-            
+        self.dir = dir
+        self.nrows = nrows
         self.num_cols = num_cols
         self.topic_cols = topic_cols
         self.tar_cols = tar_cols
 
-        # print(self.data.dtypes)
+        # process cat cols: embed index from the shared feature metadata of the whole file, whatever nrows is
+        self.meta = load_metadata(dir, cat_cols=cat_cols, index_col=0)
+        self.cat_cols = cat_cols
+        self.embed_cols = [f'{cat_col}_index' for cat_col in cat_cols]
 
         self.x_trans_list = x_transforms
         self.y_trans_list = y_transforms
 
+        # inputs as contiguous typed blocks from the memory-mapped tensor store, so DataLoader workers and
+        # concurrent runs share them: text n*2*len (ids, mask), non-text n*features, target n*tasks
+        key = store_key(dir, dataset='BertData', cat_cols=cat_cols, num_cols=num_cols, topic_cols=topic_cols, tar_cols=tar_cols,
+                        nrows=nrows, bert=bert, max_padding_len=max_padding_len,
+                        x_transforms=transform_names(x_transforms), y_transforms=transform_names(y_transforms))
+        store = load_tensors(key, lambda: self.build_tensors(bert, max_padding_len))
+        self.text, self.non_text, self.y = store['text'], store['non_text'], store['y']
+
+    def build_tensors(self, bert, max_padding_len):
+        #load data
+        data = read_columns(self.dir, index_col=0, nrows=self.nrows)
+        # print(data.columns)
+        # print(data.dtypes)
+
+        # #generate onehot encoding
+        # data = pd.get_dummies(data, columns=onehot_cols)
+
+        data = data.assign(**self.meta.encode(data, self.cat_cols))
+
+        # process text data: for bert input 
+        input_ids, attention_masks = encode_titles(data['item_title'].tolist(), bert, max_padding_len,
+                                                   source=self.dir, tag=f'item_title|nrows={self.nrows}')
+
+        return {
+            'text': apply_transforms(np.stack([input_ids, attention_masks], axis=1), self.x_trans_list),
+            'non_text': apply_transforms(data[self.num_cols+self.embed_cols+self.topic_cols].to_numpy(dtype=np.float32), self.x_trans_list),
+            'y': apply_transforms(data[self.tar_cols].to_numpy(), self.y_trans_list),
+        }
+
     def __len__(self):
-        return len(self.data)
+        return len(self.text)
 
     def __getitem__(self, idx):
-        record = self.data.iloc[idx]
-        text_input = record[self.text_cols]
-        non_text_input = record[self.num_cols+self.embed_cols+self.topic_cols].astype(np.float32)
-        # print(non_text_input)
-        y = record[self.tar_cols]
-
-        if self.x_trans_list:
-            for trsfm in self.x_trans_list:
-                text_input = np.stack(text_input.values)
-                text_input = trsfm(text_input)
-                non_text_input = trsfm(non_text_input)
-        if self.y_trans_list:
-            for trsfm in self.y_trans_list:
-                y = trsfm(y)
-
-        # print(text_input)
-        # print(non_text_input)
-        # print(y)
-        
-        return (text_input, non_text_input), y
+        return (self.text[idx], self.non_text[idx]), self.y[idx]
     
+    def get_text_lengths(self):
+        return self.text[:, 1].sum(dim=1).numpy()
+
     def get_task_num(self):
         return len(self.tar_cols)
     
     def get_embed_feature_unique_count(self):
-        return [self.data[x].nunique()+1 for x in self.embed_cols]
+        return self.meta.unique_counts(self.cat_cols)
     
     def get_num_feature_count(self):
         return len(self.num_cols)
@@ -96,8 +82,9 @@ class BertData(Dataset):
         return len(self.embed_cols)
     
     def get_pos_data(self):
-        pos_data = self.data[self.data['viral']==1]
+        data = read_columns(self.dir, index_col=0, nrows=self.nrows)
+        pos_data = data[data['viral']==1]
         return pos_data
     
     def get_class_count(self):
-        return self.data['viral'].value_counts()
\ No newline at end of file
+        return read_columns(self.dir, usecols=['viral'], index_col=0, nrows=self.nrows)['viral'].value_counts()
\ No newline at end of file
@@ -8,91 +8,82 @@ import torch
 torch.manual_seed(666)
 from torch.utils.data import Dataset
 
-from transformers import BertTokenizer
+from dataset.columnar import read_columns
+from dataset.metadata import load_metadata
+from dataset.tokencache import encode_titles
+from dataset.tensorstore import load_tensors, store_key, transform_names
+from dataset.transform import apply_transforms
+from dataset.negsampler import sample_bpr_pairs, negative_candidates
+from dataset.pairdata import BprPairData, BprResampledData
 
 class BprData():
-    def __init__(self, cat_cols=[], num_cols=[], topic_cols=[], user_cols=[], tar_col='viral', dir="./data/eastmoney_bert.csv", max_padding_len=32, x_transforms=None, bert='bert-base-chinese'):
+    def __init__(self, cat_cols=[], num_cols=[], topic_cols=[], user_cols=[], tar_col='viral', dir="./data/eastmoney_bert.csv", max_padding_len=32, x_transforms=None, bert='bert-base-chinese', resample=False, sample_in_workers=False):
         
-        self.data = pd.read_csv(dir, encoding='utf-8')
-        self.cat_cols = cat_cols
-        self.user_cols = user_cols
+        self.dir = dir
         self.num_cols = num_cols
         self.topic_cols = topic_cols
         self.tar_col = tar_col
 
-        train_dir = './data/full_train_data.csv'
-        valid_dir = './data/full_valid_data.csv'
-        test_dir = './data/full_test_data.csv'
-        train_bpr_dir = "./data/eastmoney_bpr_train.csv"
-        valid_bpr_dir = "./data/eastmoney_bpr_valid.csv"
+        split_dir = './data/full_split_index.npz'
+        train_bpr_dir = "./data/eastmoney_bpr_train_pairs.npy"
+        valid_bpr_dir = "./data/eastmoney_bpr_valid_pairs.npy"
 
-        self.cat_cols_index = []
-        self.data[cat_cols] = self.data[cat_cols].apply(lambda c: c.astype('category'))
-        for cat_col in cat_cols:
-            self.data[f'{cat_col}_index'] = self.data[cat_col].cat.codes+1 #+1 for nan cases
-            self.cat_cols_index.append(f'{cat_col}_index')
-        self.cat_cols = self.cat_cols_index
+        data = read_columns(dir)
 
-        self.user_cols_index = []
-        self.data[user_cols] = self.data[user_cols].apply(lambda c: c.astype('category'))
-        for user_col in user_cols:
-            self.data[f'{user_col}_index'] = self.data[user_col].cat.codes+1 #+1 for nan cases
-            self.user_cols_index.append(f'{user_col}_index')
-        self.user_cols = self.user_cols_index
+        # category codes from the shared feature metadata: {col}_index = 1 + vocabulary position, 0 for nan
+        self.meta = load_metadata(dir, cat_cols=cat_cols+user_cols)
+        data = data.assign(**self.meta.encode(data, cat_cols+user_cols))
+        self.cat_cols = [f'{cat_col}_index' for cat_col in cat_cols]
+        self.user_cols = [f'{user_col}_index' for user_col in user_cols]
+        self.cat_feature_cols = cat_cols
+        self.user_feature_cols = user_cols
 
-        
-        if not (exists(train_dir) and exists(valid_dir) and exists(test_dir)): # split train test data
+        # train:valid:test = 8:1:1 rows of data, stored as index arrays
+        if not exists(split_dir):
             gen = torch.Generator()
             gen.manual_seed(666)
-            train_data, valid_data, test_data = random_split(self.data, [0.8,0.1,0.1], generator=gen) #train:valid:test = 8:1:1
-            
-            #save test data for other model comparison
-            train_data.dataset.iloc[train_data.indices].to_csv(train_dir, index=False, encoding="utf-8")
-            valid_data.dataset.iloc[valid_data.indices].to_csv(valid_dir, index=False, encoding="utf-8")
-            test_data.dataset.iloc[test_data.indices].to_csv(test_dir, index=False, encoding="utf-8")
-
-        train_data = pd.read_csv(train_dir, encoding='utf-8')
+            splits = random_split(range(len(data)), [0.8,0.1,0.1], generator=gen)
+            np.savez(split_dir, **{name: np.asarray(split.indices, dtype=np.int64) for name, split in zip(['train', 'valid', 'test'], splits)})
+        with np.load(split_dir) as split:
+            train_rows, valid_rows, test_rows = split['train'], split['valid'], split['test']
+
+        # save the split rows for other model comparison (machine leraning code.ipynb), once
+        for rows, split_csv in [(train_rows, './data/full_train_data.csv'), (valid_rows, './data/full_valid_data.csv'), (test_rows, './data/full_test_data.csv')]:
+            if not exists(split_csv):
+                data.iloc[rows].to_csv(split_csv, index=False, encoding="utf-8")
+
+        # one post table over all rows, every split indexes into it
+        posts = bpr_post_table(data, 
+                               self.cat_cols, 
+                               self.user_cols, 
+                               self.num_cols, 
+                               self.topic_cols,
+                               bert, 
+                               max_padding_len,
+                               x_transforms,
+                               source=dir)
 
         # negative sample data
-        self.train_data = BprSampledData(train_data, 
-                                        train_bpr_dir,
-                                        self.cat_cols, 
-                                        self.user_cols, 
-                                        self.num_cols, 
-                                        self.topic_cols,
-                                        bert, 
-                                        max_padding_len,
-                                        x_transforms)
-        
-        valid_data = pd.read_csv(valid_dir, encoding='utf-8')
+        if resample: # redraw negatives every epoch from the pointwise train split
+            train_data = data.iloc[train_rows]
+            label = train_data[self.tar_col].to_numpy()
+            pos_idx, start, count, pool = negative_candidates(train_data, label==1, label==0)
+            self.train_data = BprResampledData(posts,
+                                               (train_rows[pos_idx], start, count, train_rows[pool]),
+                                               neg_sample_num=10,
+                                               sample_in_workers=sample_in_workers)
+        else:
+            self.train_data = BprSampledData(data, train_rows, train_bpr_dir, posts)
         
-        self.valid_data = BprSampledData(valid_data,
-                                        valid_bpr_dir,
-                                        self.cat_cols,
-                                        self.user_cols,
-                                        self.num_cols,
-                                        self.topic_cols,
-                                        bert,
-                                        max_padding_len,
-                                        x_transforms)
+        self.valid_data = BprSampledData(data, valid_rows, valid_bpr_dir, posts)
         
-        test_data = pd.read_csv(test_dir, encoding='utf-8')
-        
-        self.test_data = BprTestData(test_data, 
-                                    self.cat_cols, 
-                                    self.user_cols, 
-                                    self.num_cols, 
-                                    self.topic_cols, 
-                                    self.tar_col, 
-                                    bert, 
-                                    max_padding_len,
-                                    x_transforms)
+        self.test_data = BprTestData(posts, test_rows, data[self.tar_col].to_numpy(), x_transforms)
     
     def get_cat_feature_unique_count(self):
-        return [self.data[x].nunique()+1 for x in self.cat_cols]
+        return self.meta.unique_counts(self.cat_feature_cols)
     
     def get_user_feature_unique_count(self):
-        return [self.data[x].nunique()+1 for x in self.user_cols]
+        return self.meta.unique_counts(self.user_feature_cols)
     
     def get_num_feature_count(self):
         return len(self.num_cols)
@@ -107,227 +98,72 @@ class BprData():
         return len(self.topic_cols)
     
     def get_pos_data(self):
-        pos_data = self.data[self.data['viral']==1]
+        data = read_columns(self.dir)
+        pos_data = data[data['viral']==1]
         return pos_data
     
     def get_class_count(self):
-        return self.data['viral'].value_counts()
-    
-        
-class BprSampledData(Dataset):
-    def __init__(self, data, dir, cat_cols, user_cols, num_cols, topic_cols, bert, max_padding_len, x_transforms):
+        return read_columns(self.dir, usecols=['viral'])['viral'].value_counts()
+
+
+def bpr_post_table(data, cat_cols, user_cols, num_cols, topic_cols, bert, max_padding_len, x_transforms, source=None):
+    ## text n*2*len (ids, mask), non-text n*features, user n*user_features
+    def build():
+        # process text data: for bert input
+        input_ids, attention_masks = encode_titles(data['item_title'].tolist(), bert, max_padding_len,
+                                                   source=source, tag='item_title', desc="encode bpr data titles")
+        return {
+            'text': apply_transforms(np.stack([input_ids, attention_masks], axis=1), x_transforms),
+            'non_text': apply_transforms(data[num_cols+cat_cols+topic_cols].to_numpy(dtype=np.float32), x_transforms),
+            'user': apply_transforms(data[user_cols].to_numpy(dtype=np.float32), x_transforms),
+        }
+
+    if source is None:
+        posts = build()
+    else: # memory-mapped from the tensor store, shared by DataLoader workers and concurrent runs
+        posts = load_tensors(store_key(source, dataset='bpr_post_table', cat_cols=cat_cols, user_cols=user_cols, num_cols=num_cols,
+                                       topic_cols=topic_cols, bert=bert, max_padding_len=max_padding_len,
+                                       transforms=transform_names(x_transforms)),
+                             build)
+    return posts['text'], posts['non_text'], posts['user']
+
+
+class BprSampledData(BprPairData):
+    """
+    Fixed bpr pairs of the split `rows` of data, over the shared post table `posts` (one row per row of data).
+    The pairs are sampled once and saved to `dir` as positions within the split.
+    """
+    def __init__(self, data, rows, dir, posts):
         
         if not exists(dir):
-            self.form_bpr_train_data(data, dir)
-        self.data = pd.read_csv(dir, delimiter='<', encoding='utf-8')
-
-        # print(self.data.columns)
-
-        ##---for pos cols-----
-        self.cat_cols = cat_cols
-        self.user_cols = user_cols
-        self.num_cols = num_cols
-        self.topic_cols = topic_cols
-
-        # process text data: for bert input 
-        tokenizer = BertTokenizer.from_pretrained(bert)
-        input_ids = []
-        attention_masks = []
-        print("encode pos data titles")
-        for text in tqdm(self.data['item_title'], total=self.data.shape[0]):
-            encoded_dict = tokenizer.encode_plus(text,
-                                                add_special_tokens=True,
-                                                max_length=max_padding_len,
-                                                truncation=True,
-                                                padding='max_length',
-                                                return_attention_mask=True,
-                                                return_tensors='pt')
-            input_ids.append(np.array(encoded_dict['input_ids'].squeeze()))
-            attention_masks.append(np.array(encoded_dict['attention_mask'].squeeze()))
-            # print(text)
-            # print(encoded_dict['input_ids'])
-        self.data['title_id'] = input_ids
-        self.data['title_mask'] = attention_masks
-
-        self.text_cols=['title_id', 'title_mask']
-        ##---for neg cols------
-
-        # process text data: for bert input 
-        neg_input_ids = []
-        neg_attention_masks = []
-        print("encode neg data titles")
-        for text in tqdm(self.data['neg_item_title'], total=self.data.shape[0]):
-            encoded_dict = tokenizer.encode_plus(text,
-                                                add_special_tokens=True,
-                                                max_length=max_padding_len,
-                                                truncation=True,
-                                                padding='max_length',
-                                                return_attention_mask=True,
-                                                return_tensors='pt')
-            neg_input_ids.append(np.array(encoded_dict['input_ids'].squeeze()))
-            neg_attention_masks.append(np.array(encoded_dict['attention_mask'].squeeze()))
-            # print(text)
-            # print(encoded_dict['input_ids'])
-        self.data['neg_title_id'] = neg_input_ids
-        self.data['neg_title_mask'] = neg_attention_masks
-        self.neg_text_cols=['neg_title_id', 'neg_title_mask']
-
-        self.neg_cat_cols = ['neg_'+x for x in cat_cols]    
-        self.neg_num_cols = ['neg_'+x for x in num_cols]
-        self.neg_user_cols = ['neg_'+x for x in user_cols]
-        self.neg_topic_cols = ['neg_'+x for x in topic_cols]
-
-        self.x_trans_list = x_transforms
+            self.form_bpr_train_data(data.iloc[rows], dir)
+        self.pairs = torch.from_numpy(rows[np.load(dir)].astype(np.int32)) # (pos row, neg row) in posts
+        self.posts = posts
 
         print(f"loaded bpr data from {dir}")
 
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, idx):
-        record = self.data.iloc[idx]
-
-        #----for pos columns:
-        pos_text_input = record[self.text_cols]
-        pos_non_text_input = record[self.num_cols+self.cat_cols+self.topic_cols].astype(np.float32)
-        pos_user_input = record[self.user_cols].astype(np.float32)
-
-        if self.x_trans_list:
-            for trsfm in self.x_trans_list:
-                pos_text_input = np.stack(pos_text_input.values)
-                pos_text_input = trsfm(pos_text_input)
-                pos_non_text_input = trsfm(pos_non_text_input)
-                pos_user_input = trsfm(pos_user_input)
-
-        #----for neg columns:
-        neg_text_input = record[self.neg_text_cols]
-        neg_non_text_input = record[self.neg_num_cols+self.neg_cat_cols+self.neg_topic_cols].astype(np.float32)
-        neg_user_input = record[self.neg_user_cols].astype(np.float32)
-        # print(pos_non_text_input)
-        # print(neg_user_input)
-
-        if self.x_trans_list:
-            for trsfm in self.x_trans_list:
-                neg_text_input = np.stack(neg_text_input.values)
-                neg_text_input = trsfm(neg_text_input)
-                neg_non_text_input = trsfm(neg_non_text_input)
-                neg_user_input = trsfm(neg_user_input)
-        
-        return (pos_text_input, pos_non_text_input, pos_user_input), (neg_text_input, neg_non_text_input, neg_user_input)
-
     def form_bpr_train_data(self, data, dir):
         print(f"sample negative bpr data and save to {dir}")
-        positive_rows = data[data['viral'] == 1]
-
-        neg_sample_num = 10
-        null_count = 0
-
-        # Open the output file
-        with open(dir, 'w', encoding='utf-8') as f:
-            first_line = True
-
-            # Iterate over each positive row
-            for _, positive_row in tqdm(positive_rows.iterrows(), total=positive_rows.shape[0]):
-                # Find corresponding negative row based on specified conditions
-                negative_rows = data[(data['item_author_cate'] == positive_row['item_author_cate']) &
-                                    (data['article_author'] == positive_row['article_author']) &
-                                    (data['article_source_cate'] == positive_row['article_source_cate']) &
-                                    (data['viral'] == 0)]
-                
-                # Check if there are valid negative rows
-                if len(negative_rows)==0:
-                    negative_rows = data[(data['stock_code'] == positive_row['stock_code']) &
-                                        (data['viral'] == 0)]
-                    
-                if len(negative_rows)==0:
-                    null_count+=1
-                    continue
-
-                elif len(negative_rows)==1:
-                    neg_samples = negative_rows.iloc[0]
-                    concatenated_row = pd.concat([positive_row, neg_samples.add_prefix('neg_')])
-                    if first_line:
-                        f.write('<'.join(map(str, concatenated_row.keys()))+'\n')
-                        first_line = False
-
-                    # Write the concatenated row to the file
-                    f.write('<'.join(map(str, concatenated_row.values)) + '\n')
-                    continue
-
-                elif 1<len(negative_rows)<=neg_sample_num:
-                    # Take the first negative row
-                    neg_samples = negative_rows
-                
-                elif len(negative_rows)>neg_sample_num:
-                    # Take all negative rows
-                    neg_samples = negative_rows.sample(n=neg_sample_num, replace=False)
-                
-                # Iterate over each sampled negative row
-                for _, negative_row in neg_samples.iterrows():
-                    # Concatenate negative row to positive row with modifications
-                    concatenated_row = pd.concat([positive_row, negative_row.add_prefix('neg_')])
-
-                    if first_line:
-                        f.write('<'.join(map(str, concatenated_row.keys()))+'\n')
-                        first_line = False
-
-                    # Write the concatenated row to the file
-                    f.write('<'.join(map(str, concatenated_row.values)) + '\n')
+        pairs = sample_bpr_pairs(data, neg_sample_num=10)
+        np.save(dir, pairs)
                 
 
 class BprTestData(Dataset):
-    def __init__(self, data, cat_cols, user_cols, num_cols, topic_cols, tar_col, bert, max_padding_len, x_transforms):
-        self.data = data
-        self.cat_cols = cat_cols
-        self.user_cols = user_cols
-        self.num_cols = num_cols
-        self.topic_cols = topic_cols
-        self.tar_col = tar_col
-
-        # process text data: for bert input 
-        tokenizer = BertTokenizer.from_pretrained(bert)
-        input_ids = []
-        attention_masks = []
-        print("encode test data titles")
-        for text in tqdm(self.data['item_title'], total=self.data.shape[0]):
-            encoded_dict = tokenizer.encode_plus(text,
-                                                add_special_tokens=True,
-                                                max_length=max_padding_len,
-                                                truncation=True,
-                                                padding='max_length',
-                                                return_attention_mask=True,
-                                                return_tensors='pt')
-            input_ids.append(np.array(encoded_dict['input_ids'].squeeze()))
-            attention_masks.append(np.array(encoded_dict['attention_mask'].squeeze()))
-            # print(text)
-            # print(encoded_dict['input_ids'])
-        self.data['title_id'] = input_ids
-        self.data['title_mask'] = attention_masks
-
-        self.text_cols=['title_id', 'title_mask']
-
-        self.x_trans_list = x_transforms
-        
-        
+    """
+    Pointwise test rows: a view of the split `rows` over the shared post table, with targets y for every row of it.
+    """
+    def __init__(self, posts, rows, y, x_transforms):
+        self.text, self.non_text, self.user = posts
+        self.rows = torch.from_numpy(rows)
+        self.y = apply_transforms(y, x_transforms)
 
     def __len__(self):
-        return len(self.data)
+        return len(self.rows)
 
     def __getitem__(self, idx):
-        record = self.data.iloc[idx]
-
-        #----for pos columns:
-        text_input = record[self.text_cols]
-        non_text_input = record[self.num_cols+self.cat_cols+self.topic_cols].astype(np.float32)
-        user_input = record[self.user_cols].astype(np.float32)
-        y = record[self.tar_col]
-
-        if self.x_trans_list:
-            for trsfm in self.x_trans_list:
-                text_input = np.stack(text_input.values)
-                text_input = trsfm(text_input)
-                non_text_input = trsfm(non_text_input)
-                user_input = trsfm(user_input)
-                y = trsfm(y)
+        rows = self.rows[idx]
+        return self.text[rows], self.non_text[rows], self.user[rows], self.y[rows]
 
-        return text_input, non_text_input, user_input, y
\ No newline at end of file
+    def __getitems__(self, indices):
+        # fetch a whole batch with one gather per tensor, use with batch_collate
+        return self.__getitem__(torch.as_tensor(indices))
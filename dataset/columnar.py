@@ -0,0 +1,164 @@
+"""
+Typed columnar copies of the data csvs: a directory of one .npy per column next to the csv (train1.csv ->
+train1.cols/), written once and then read with column projection and memory-mapped numeric columns,
+instead of re-parsing the csv on every run. Text columns are stored as utf-8 bytes plus offsets.
+
+convert ahead of time from the repo root, e.g.:
+    python -m dataset.columnar ./data/train_bpr1.csv ./data/test1.csv
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+
+def bundle_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.cols'
+
+@contextmanager
+def swap_lock(bundle, stale_after=300):
+    # portable exclusive lock for swapping a bundle: creating a directory is atomic on every platform. A lock left by
+    # a killed process is taken over once it is older than stale_after seconds (a swap takes far less)
+    lock = bundle + '.swaplock'
+    while True:
+        try:
+            os.mkdir(lock)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) > stale_after:
+                    os.rmdir(lock)
+                    continue
+            except OSError: # released meanwhile
+                continue
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.rmdir(lock)
+
+def _read_meta(bundle):
+    with open(os.path.join(bundle, 'meta.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+def is_fresh(csv_path, bundle=None, **read_csv_kwargs):
+    # bundle exists and was converted from the current csv (same size and mtime) with the same read options
+    bundle = bundle or bundle_path(csv_path)
+    if not os.path.exists(os.path.join(bundle, 'meta.json')):
+        return False
+    meta = _read_meta(bundle)
+    if meta.get('version') != FORMAT_VERSION or meta['read_options'] != read_csv_kwargs:
+        return False
+    if not os.path.exists(csv_path): # only the bundle was shipped
+        return True
+    stat = os.stat(csv_path)
+    return meta['source_size'] == stat.st_size and meta['source_mtime_ns'] == stat.st_mtime_ns
+
+def convert_csv(csv_path, bundle=None, **read_csv_kwargs):
+    """Parse csv_path once (read_csv_kwargs as for pd.read_csv, e.g. sep='<') and write its columnar bundle."""
+    bundle = bundle or bundle_path(csv_path)
+    data = pd.read_csv(csv_path, **read_csv_kwargs)
+    index_name = None
+    if read_csv_kwargs.get('index_col') is not None:
+        index_name = data.index.name or '__index__'
+        data = data.reset_index(names=index_name)
+
+    tmp = bundle + f'.{os.getpid()}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    columns = []
+    for i, col in enumerate(data.columns):
+        values = data[col]
+        name = f'c{i}'
+        if not (pd.api.types.is_numeric_dtype(values.dtype) or pd.api.types.is_bool_dtype(values.dtype)):
+            null = values.isna().to_numpy()
+            encoded = [b'' if n else str(v).encode('utf-8') for v, n in zip(values.tolist(), null)]
+            offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(b) for b in encoded])
+            np.save(os.path.join(tmp, f'{name}.bytes.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+            np.save(os.path.join(tmp, f'{name}.offsets.npy'), offsets)
+            if null.any():
+                np.save(os.path.join(tmp, f'{name}.null.npy'), null)
+            columns.append({'name': col, 'file': name, 'kind': 'text', 'null': bool(null.any())})
+        else:
+            np.save(os.path.join(tmp, f'{name}.npy'), values.to_numpy())
+            columns.append({'name': col, 'file': name, 'kind': 'array'})
+
+    stat = os.stat(csv_path)
+    meta = {'version': FORMAT_VERSION, 'rows': len(data), 'columns': columns, 'index': index_name, 'read_options': read_csv_kwargs,
+            'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+    with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    # swap the finished bundle in, so an interrupted conversion never leaves a partial one behind. The swap holds a
+    # lock, so concurrent conversions never remove each other's bundle: when another one already swapped in a bundle
+    # of the current csv, keep it and drop ours
+    with swap_lock(bundle):
+        if is_fresh(csv_path, bundle, **read_csv_kwargs):
+            shutil.rmtree(tmp, ignore_errors=True)
+        else:
+            shutil.rmtree(bundle, ignore_errors=True) # stale
+            os.replace(tmp, bundle)
+            print(f"converted {csv_path} to {bundle} ({len(data)} rows, {len(columns)} columns)")
+    return bundle
+
+def _load_column(bundle, column, start, stop, mmap):
+    path = os.path.join(bundle, column['file'])
+    if column['kind'] == 'array':
+        values = np.load(path + '.npy', mmap_mode='r' if mmap else None)
+        return values[start:stop]
+
+    offsets = np.load(path + '.offsets.npy', mmap_mode='r')[start:None if stop is None else stop+1]
+    blob = np.load(path + '.bytes.npy', mmap_mode='r')[offsets[0]:offsets[-1]].tobytes()
+    offsets = np.asarray(offsets) - offsets[0]
+    values = np.array([blob[a:b].decode('utf-8') for a, b in zip(offsets[:-1].tolist(), offsets[1:].tolist())], dtype=object)
+    if column['null']:
+        null = np.load(path + '.null.npy', mmap_mode='r')[start:start+len(values)]
+        values[null] = np.nan
+    return pd.Series(values, copy=False).infer_objects() # same text dtype read_csv would give
+
+def _fresh_meta(csv_path, read_csv_kwargs):
+    # metadata of the csv's bundle, converting the csv first if the bundle is missing or stale
+    bundle = bundle_path(csv_path)
+    if not is_fresh(csv_path, bundle, **read_csv_kwargs):
+        convert_csv(csv_path, bundle, **read_csv_kwargs)
+    return bundle, _read_meta(bundle)
+
+def count_rows(csv_path, **read_csv_kwargs):
+    """Rows of csv_path, from its columnar bundle's metadata."""
+    return _fresh_meta(csv_path, read_csv_kwargs)[1]['rows']
+
+def read_columns(csv_path, usecols=None, nrows=None, mmap=True, **read_csv_kwargs):
+    """
+    Drop-in for pd.read_csv(csv_path, usecols=usecols, nrows=nrows, **read_csv_kwargs) served from the columnar
+    bundle, converting the csv first if the bundle is missing or stale. Only the usecols columns are loaded, numeric
+    ones memory-mapped when mmap. With index_col the stored index is always kept, whatever usecols is.
+    """
+    return read_rows(csv_path, 0, nrows, usecols=usecols, mmap=mmap, **read_csv_kwargs)
+
+def read_rows(csv_path, start, stop, usecols=None, mmap=True, **read_csv_kwargs):
+    """
+    Rows start:stop of csv_path (stop=None reads to the end) as read_columns loads them, touching only those rows of
+    the bundle: streams read a large csv chunk by chunk this way, in any order, without parsing the rows before.
+    """
+    bundle, meta = _fresh_meta(csv_path, read_csv_kwargs)
+
+    by_name = {c['name']: c for c in meta['columns']}
+    names = [c['name'] for c in meta['columns']] if usecols is None else list(usecols)
+    missing = [x for x in names if x not in by_name]
+    if missing:
+        raise ValueError(f"Usecols do not match columns, columns expected but not found: {missing}")
+    if meta['index'] and meta['index'] not in names:
+        names = [meta['index']] + names
+
+    data = pd.DataFrame({x: _load_column(bundle, by_name[x], start, stop, mmap) for x in names}, copy=False)
+    if meta['index']:
+        data = data.set_index(meta['index'])
+        if data.index.name == '__index__':
+            data.index.name = None
+    return data
@@ -6,9 +6,15 @@ import torch
 torch.manual_seed(666)
 from torch.utils.data import Dataset
 
-from transformers import BertTokenizer
+from dataset.columnar import read_columns
+from dataset.tokencache import encode_titles, tokenize_batch, file_hash
+from dataset.tensorstore import load_tensors, store_key, transform_names
+from dataset.transform import apply_transforms
+from dataset.pairdata import BprPairData, BprResampledData, normalize_pairs
+from dataset.negsampler import filled_candidates
+from dataset.streamdata import CsvStream
 
-class IncBprData(Dataset):
+class IncBprData(BprPairData):
     def __init__(self, 
                  data_dir,
                  post_cols=[], 
@@ -16,7 +22,8 @@ class IncBprData(Dataset):
                  tar_col='viral', 
                  max_padding_len=32, 
                  x_transforms=None, 
-                 bert='bert-base-chinese'):
+                 bert='bert-base-chinese',
+                 nrows=50000):
         
         
         self.post_cols = post_cols
@@ -24,50 +31,35 @@ class IncBprData(Dataset):
         self.tar_col = tar_col
         self.x_trans_list = x_transforms
 
-        self.data = pd.read_csv(data_dir,
-                                usecols=['item_title','neg_item_title']
-                                +post_cols+['neg_'+x for x in post_cols]
-                                +author_cols+['neg_'+x for x in author_cols], nrows=50000)
+        # post table and pairs from the memory-mapped tensor store, shared by workers and concurrent runs
+        key = store_key(data_dir, dataset='IncBprData', post_cols=post_cols, author_cols=author_cols, nrows=nrows,
+                        bert=bert, max_padding_len=max_padding_len, transforms=transform_names(x_transforms))
+        store = load_tensors(key, lambda: self.build_tensors(data_dir, bert, max_padding_len, nrows))
+        ## text n*2*len (ids, mask), post n*post_features, author n*author_features
+        self.posts = (store['text'], store['post'], store['author'])
+        self.pairs = store['pairs']
+        print(f"{len(self.pairs)} bpr pairs over {len(self.posts[0])} unique posts")
+
+    def build_tensors(self, data_dir, bert, max_padding_len, nrows):
+        data = read_columns(data_dir,
+                            usecols=['item_title','neg_item_title']
+                            +self.post_cols+['neg_'+x for x in self.post_cols]
+                            +self.author_cols+['neg_'+x for x in self.author_cols], nrows=nrows)
+
+        # every line repeats the full positive post, so keep each post once and index it from (pos, neg) pairs
+        posts, pairs = normalize_pairs(data, ['item_title']+self.post_cols+self.author_cols)
+        del data
 
         # process text data: for bert input 
-        tokenizer = BertTokenizer.from_pretrained(bert)
-        input_ids = []
-        attention_masks = []
-        print("encode positive sample titles")
-        for text in tqdm(self.data['item_title'], total=self.data.shape[0]):
-            encoded_dict = tokenizer.encode_plus(text,
-                                                add_special_tokens=True,
-                                                max_length=max_padding_len,
-                                                truncation=True,
-                                                padding='max_length',
-                                                return_attention_mask=True,
-                                                return_tensors='pt')
-            input_ids.append(np.array(encoded_dict['input_ids'].squeeze()))
-            attention_masks.append(np.array(encoded_dict['attention_mask'].squeeze()))
-            # print(text)
-            # print(encoded_dict['input_ids'])
-        self.data['title_id'] = input_ids
-        self.data['title_mask'] = attention_masks
-
-        self.text_cols=['title_id', 'title_mask']
-
-        neg_input_ids = []
-        neg_attention_masks = []
-        print("encode negative sample titles")
-        for text in tqdm(self.data['neg_item_title'], total=self.data.shape[0]):
-            encoded_dict = tokenizer.encode_plus(text,
-                                                add_special_tokens=True,
-                                                max_length=max_padding_len,
-                                                truncation=True,
-                                                padding='max_length',
-                                                return_attention_mask=True,
-                                                return_tensors='pt')
-            neg_input_ids.append(np.array(encoded_dict['input_ids'].squeeze()))
-            neg_attention_masks.append(np.array(encoded_dict['attention_mask'].squeeze()))
-            # print(text)
-            # print(encoded_dict['input_ids'])
-        self.data['neg_title_id'] = neg_input_ids
-        self.data['neg_title_mask'] = neg_attention_masks
+        input_ids, attention_masks = encode_titles(posts['item_title'].tolist(), bert, max_padding_len,
+                                                   source=data_dir, tag=f'posts|nrows={nrows}', desc="encode post titles")
+
+        return {
+            'text': apply_transforms(np.stack([input_ids, attention_masks], axis=1), self.x_trans_list),
+            'post': apply_transforms(posts[self.post_cols].to_numpy(dtype=np.int8), self.x_trans_list),
+            'author': apply_transforms(posts[self.author_cols].to_numpy(dtype=np.int8), self.x_trans_list),
+            'pairs': pairs,
+        }
 
     
     # def get_post_feature_unique_count(self):
@@ -87,36 +79,85 @@ class IncBprData(Dataset):
     #     return pos_data
     
     # def get_class_count(self):
-    #     return self.data['viral'].value_counts()    
+    #     return self.data['viral'].value_counts()
 
-    def __len__(self):
-        return len(self.data)
 
-    def __getitem__(self, idx):
-        record = self.data.iloc[idx]
-        #----for pos columns:
-        pos_text_input = record[self.text_cols]
-        pos_post_input = record[self.post_cols].astype(np.int8)
-        pos_author_input = record[self.author_cols].astype(np.int8)
-        if self.x_trans_list:
-            for trsfm in self.x_trans_list:
-                pos_text_input = np.stack(pos_text_input.values)
-                pos_text_input = trsfm(pos_text_input)
-                pos_post_input = trsfm(pos_post_input)
-                pos_author_input = trsfm(pos_author_input)
-
-        #----for neg columns:
-        neg_text_input = record[['neg_' + x for x in self.text_cols]]
-        neg_post_input = record[['neg_' + x for x in self.post_cols]].astype(np.int8)
-        neg_author_input = record[['neg_' + x for x in self.author_cols]].astype(np.int8)
-
-        if self.x_trans_list:
-            for trsfm in self.x_trans_list:
-                neg_text_input = np.stack(neg_text_input.values)
-                neg_text_input = trsfm(neg_text_input)
-                neg_post_input = trsfm(neg_post_input)
-                neg_author_input = trsfm(neg_author_input)
-        return (pos_text_input, pos_post_input, pos_author_input), (neg_text_input, neg_post_input, neg_author_input)
+
+class IncResampledData(BprResampledData):
+    """
+    v3 bpr training data with negatives redrawn every epoch from a pointwise split (e.g. train1.csv instead of
+    train_bpr1.csv), matched like the sample_bpr notebook step: negatives with the same (item_author, article_author,
+    article_source); a positive with fewer than neg_sample_num of those instead draws from the union of them and up
+    to neg_sample_num random same article_source and same stock_code negatives (see filled_candidates).
+    The negatives of ref_dirs, the earlier pointwise splits, are in the pool too, as the notebook's ref_data.
+    """
+    def __init__(self, 
+                 data_dir,
+                 post_cols=[], 
+                 author_cols=[], 
+                 tar_col='viral', 
+                 max_padding_len=32, 
+                 x_transforms=None, 
+                 bert='bert-base-chinese',
+                 neg_sample_num=3,
+                 key_sets=[['item_author', 'article_author', 'article_source'], ['article_source'], ['stock_code']],
+                 ref_dirs=[],
+                 seed=666,
+                 sample_in_workers=False):
+
+        self.post_cols = post_cols
+        self.author_cols = author_cols
+        self.tar_col = tar_col
+        self.x_trans_list = x_transforms
+
+        key = store_key(data_dir, dataset='IncResampledData', post_cols=post_cols, author_cols=author_cols, tar_col=tar_col,
+                        key_sets=key_sets, neg_sample_num=neg_sample_num, seed=seed, refs=[file_hash(x) for x in ref_dirs],
+                        bert=bert, max_padding_len=max_padding_len, transforms=transform_names(x_transforms))
+        store = load_tensors(key, lambda: self.build_tensors(data_dir, ref_dirs, bert, max_padding_len, key_sets, neg_sample_num, seed))
+        ## text n*2*len (ids, mask), post n*post_features, author n*author_features
+        posts = (store['text'], store['post'], store['author'])
+        candidates = tuple(store[x].numpy() for x in ('pos_idx', 'start', 'count', 'pool'))
+        super().__init__(posts,
+                         candidates,
+                         neg_sample_num=neg_sample_num,
+                         seed=seed,
+                         sample_in_workers=sample_in_workers)
+
+    def build_tensors(self, data_dir, ref_dirs, bert, max_padding_len, key_sets, neg_sample_num, seed):
+        key_cols = list(dict.fromkeys(c for key_cols in key_sets for c in key_cols))
+        usecols = list(dict.fromkeys(['item_title', self.tar_col]+self.post_cols+self.author_cols+key_cols))
+
+        # posts: the split's rows, then the negatives of the earlier splits; titles encoded (and cached) per file
+        frames, input_ids, attention_masks = [], [], []
+        for source in [data_dir] + ref_dirs:
+            data = read_columns(source, usecols=usecols)
+            tag = 'item_title'
+            if source != data_dir:
+                data = data[data[self.tar_col].to_numpy() == 0].reset_index(drop=True)
+                tag = 'negative item_title'
+            ids, masks = encode_titles(data['item_title'].tolist(), bert, max_padding_len,
+                                       source=source, tag=tag, desc=f"encode {tag}s of {source}")
+            frames.append(data)
+            input_ids.append(ids)
+            attention_masks.append(masks)
+        n_split = len(frames[0])
+        data = pd.concat(frames, ignore_index=True)
+
+        label = data[self.tar_col].to_numpy()
+        pos_mask = (label == 1) & (np.arange(len(data)) < n_split)
+        pos_idx, start, count, pool = filled_candidates(data, pos_mask, label == 0, key_sets[0], key_sets[1:], neg_sample_num, seed)
+        return {
+            'text': apply_transforms(np.stack([np.concatenate(input_ids), np.concatenate(attention_masks)], axis=1), self.x_trans_list),
+            'post': apply_transforms(data[self.post_cols].to_numpy(dtype=np.int8), self.x_trans_list),
+            'author': apply_transforms(data[self.author_cols].to_numpy(dtype=np.int8), self.x_trans_list),
+            'pos_idx': pos_idx, 'start': start, 'count': count, 'pool': pool,
+        }
+
+    def get_author_feature_count(self):
+        return len(self.author_cols)
+
+    def get_post_feature_count(self):
+        return len(self.post_cols)
 
 
 
@@ -128,54 +169,127 @@ class IncTestData(Dataset):
                  tar_col='viral', 
                  max_padding_len=32, 
                  x_transforms=None, 
-                 bert='bert-base-chinese'):
+                 bert='bert-base-chinese',
+                 nrows=50000):
         
         self.post_cols = post_cols
         self.author_cols = author_cols
         self.tar_col = tar_col
         self.x_trans_list = x_transforms
 
-        self.data = pd.read_csv(data_dir, nrows=50000)
+        key = store_key(data_dir, dataset='IncTestData', post_cols=post_cols, author_cols=author_cols, tar_col=tar_col, nrows=nrows,
+                        bert=bert, max_padding_len=max_padding_len, transforms=transform_names(x_transforms))
+        store = load_tensors(key, lambda: self.build_tensors(data_dir, bert, max_padding_len, nrows))
+        self.text, self.post, self.author, self.y = store['text'], store['post'], store['author'], store['y']
+
+    def build_tensors(self, data_dir, bert, max_padding_len, nrows):
+        data = read_columns(data_dir, usecols=['item_title', self.tar_col]+self.post_cols+self.author_cols, nrows=nrows)
 
         # process text data: for bert input 
-        tokenizer = BertTokenizer.from_pretrained(bert)
-        input_ids = []
-        attention_masks = []
-        print("encode test data titles")
-        for text in tqdm(self.data['item_title'], total=self.data.shape[0]):
-            encoded_dict = tokenizer.encode_plus(text,
-                                                add_special_tokens=True,
-                                                max_length=max_padding_len,
-                                                truncation=True,
-                                                padding='max_length',
-                                                return_attention_mask=True,
-                                                return_tensors='pt')
-            input_ids.append(np.array(encoded_dict['input_ids'].squeeze()))
-            attention_masks.append(np.array(encoded_dict['attention_mask'].squeeze()))
-            # print(text)
-            # print(encoded_dict['input_ids'])
-        self.data['title_id'] = input_ids
-        self.data['title_mask'] = attention_masks
-
-        self.text_cols=['title_id', 'title_mask']
+        input_ids, attention_masks = encode_titles(data['item_title'].tolist(), bert, max_padding_len,
+                                                   source=data_dir, tag=f'item_title|nrows={nrows}', desc="encode test data titles")
+
+        return {
+            'text': apply_transforms(np.stack([input_ids, attention_masks], axis=1), self.x_trans_list),
+            'post': apply_transforms(data[self.post_cols].to_numpy(dtype=np.int8), self.x_trans_list),
+            'author': apply_transforms(data[self.author_cols].to_numpy(dtype=np.int8), self.x_trans_list),
+            'y': apply_transforms(data[self.tar_col].to_numpy(), self.x_trans_list),
+        }
 
     def __len__(self):
-        return len(self.data)
+        return len(self.text)
 
     def __getitem__(self, idx):
-        record = self.data.iloc[idx]
-
-        text_input = record[self.text_cols]
-        post_input = record[self.post_cols].astype(np.int8)
-        author_input = record[self.author_cols].astype(np.int8)
-        y = record[self.tar_col]
-
-        if self.x_trans_list:
-            for trsfm in self.x_trans_list:
-                text_input = np.stack(text_input.values)
-                text_input = trsfm(text_input)
-                post_input = trsfm(post_input)
-                author_input = trsfm(author_input)
-                y = trsfm(y)
-
-        return text_input, post_input, author_input, y
\ No newline at end of file
+        return self.text[idx], self.post[idx], self.author[idx], self.y[idx]
+
+    def __getitems__(self, indices):
+        # fetch a whole batch with one gather per tensor, use with batch_collate
+        return self.__getitem__(torch.as_tensor(indices))
+
+
+
+class IncBprStream(CsvStream):
+    """
+    Streaming IncBprData: the whole bpr csv in chunks, with no nrows cap needed, yielded as (pos_data, neg_data)
+    batches. Titles are tokenized once per unique post of a chunk.
+    """
+    def __init__(self, 
+                 data_dir,
+                 post_cols=[], 
+                 author_cols=[], 
+                 tar_col='viral', 
+                 max_padding_len=32, 
+                 x_transforms=None, 
+                 bert='bert-base-chinese',
+                 batch_size=64,
+                 chunk_size=10000,
+                 buffer_size=0,
+                 nrows=None,
+                 num_workers=0):
+
+        self.post_cols = post_cols
+        self.author_cols = author_cols
+        self.tar_col = tar_col
+        self.x_trans_list = x_transforms
+        self.max_padding_len = max_padding_len
+        self.bert = bert
+        cols = ['item_title']+post_cols+author_cols
+        super().__init__(data_dir, cols+['neg_'+x for x in cols], batch_size=batch_size, chunk_size=chunk_size,
+                         buffer_size=buffer_size, nrows=nrows, num_workers=num_workers)
+
+    def encode_chunk(self, chunk):
+        posts, pairs = normalize_pairs(chunk, ['item_title']+self.post_cols+self.author_cols)
+        input_ids, attention_masks = tokenize_batch(posts['item_title'].tolist(), self.bert, self.max_padding_len)
+        posts = (
+            apply_transforms(np.stack([input_ids, attention_masks], axis=1), self.x_trans_list),
+            apply_transforms(posts[self.post_cols].to_numpy(dtype=np.int8), self.x_trans_list),
+            apply_transforms(posts[self.author_cols].to_numpy(dtype=np.int8), self.x_trans_list),
+        )
+        pairs = torch.from_numpy(pairs).long()
+        return tuple(x[pairs[:, 0]] for x in posts) + tuple(x[pairs[:, 1]] for x in posts)
+
+    def pack(self, rows):
+        return rows[:3], rows[3:]
+
+    def get_author_feature_count(self):
+        return len(self.author_cols)
+
+    def get_post_feature_count(self):
+        return len(self.post_cols)
+
+
+
+class IncTestStream(CsvStream):
+    """
+    Streaming IncTestData: the whole test csv in chunks, yielded as (text, post, author, y) batches in file order.
+    """
+    def __init__(self, 
+                 data_dir,
+                 post_cols=[], 
+                 author_cols=[], 
+                 tar_col='viral', 
+                 max_padding_len=32, 
+                 x_transforms=None, 
+                 bert='bert-base-chinese',
+                 batch_size=64,
+                 chunk_size=10000,
+                 nrows=None,
+                 num_workers=0):
+
+        self.post_cols = post_cols
+        self.author_cols = author_cols
+        self.tar_col = tar_col
+        self.x_trans_list = x_transforms
+        self.max_padding_len = max_padding_len
+        self.bert = bert
+        super().__init__(data_dir, ['item_title', tar_col]+post_cols+author_cols, batch_size=batch_size,
+                         chunk_size=chunk_size, nrows=nrows, num_workers=num_workers)
+
+    def encode_chunk(self, chunk):
+        input_ids, attention_masks = tokenize_batch(chunk['item_title'].tolist(), self.bert, self.max_padding_len)
+        return (
+            apply_transforms(np.stack([input_ids, attention_masks], axis=1), self.x_trans_list),
+            apply_transforms(chunk[self.post_cols].to_numpy(dtype=np.int8), self.x_trans_list),
+            apply_transforms(chunk[self.author_cols].to_numpy(dtype=np.int8), self.x_trans_list),
+            apply_transforms(chunk[self.tar_col].to_numpy(), self.x_trans_list),
+        )
@@ -0,0 +1,78 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+
+from dataset.columnar import read_columns
+from dataset.tokencache import file_hash
+
+META_VERSION = 1
+
+def meta_path(source):
+    return os.path.splitext(source)[0] + f'_meta_v{META_VERSION}.pkl'
+
+class FeatureMeta():
+    """
+    Vocabulary and embedding size of every categorical feature of a source csv, computed once and shared by
+    the datasets (code assignment) and the models (embedding sizes).
+    category columns: raw values, encoded as 1 + position in the sorted vocabulary, 0 for missing or unseen values
+    coded columns: already integer codes (e.g. the v3 *_index columns), embedding size is max code + 1
+    """
+    def __init__(self, columns, source_hash):
+        self.version = META_VERSION
+        self.columns = columns
+        self.source_hash = source_hash
+
+    def has(self, cols):
+        return all(c in self.columns for c in cols)
+
+    def unique_counts(self, cols):
+        return [self.columns[c]['unique_count'] for c in cols]
+
+    def encode(self, data, cols):
+        # {col}_index code columns for the category columns cols of data
+        return {f'{c}_index': pd.Categorical(data[c], categories=self.columns[c]['vocab']).codes.astype(np.int64)+1 for c in cols}
+
+def build_columns(data, cat_cols=[], coded_cols=[]):
+    columns = {}
+    for col in cat_cols:
+        values = pd.Categorical(data[col])
+        columns[col] = {'kind': 'category',
+                        'vocab': values.categories,
+                        # as the former nunique()+1 over the code column, so embedding sizes stay the same
+                        'unique_count': len(values.categories) + int((values.codes < 0).any()) + 1}
+    for col in coded_cols:
+        columns[col] = {'kind': 'coded', 'unique_count': int(data[col].max()+1)}
+    return columns
+
+def load_metadata(source, cat_cols=[], coded_cols=[], **read_csv_kwargs):
+    """
+    Feature metadata of the csv `source`, read from its versioned artifact (meta_path) when that was built from the
+    same file content and covers the requested columns; otherwise built from just those columns and saved.
+    read_csv_kwargs: as the datasets read `source`, so they share its columnar bundle
+    """
+    path = meta_path(source)
+    source_hash = file_hash(source)
+    meta = None
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            meta = pickle.load(f)
+        if getattr(meta, 'version', None) != META_VERSION or meta.source_hash != source_hash:
+            meta = None
+    if meta is not None and meta.has(cat_cols+coded_cols):
+        return meta
+
+    todo_cat = [c for c in cat_cols if meta is None or c not in meta.columns]
+    todo_coded = [c for c in coded_cols if meta is None or c not in meta.columns]
+    print(f"build feature metadata of {source} for {todo_cat+todo_coded}")
+    data = read_columns(source, usecols=todo_cat+todo_coded, **read_csv_kwargs)
+    columns = dict(meta.columns) if meta is not None else {}
+    columns.update(build_columns(data, todo_cat, todo_coded))
+    meta = FeatureMeta(columns, source_hash)
+
+    # write to a temp file first so an interrupted run never leaves a truncated artifact behind
+    tmp_path = path + f'.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(meta, f)
+    os.replace(tmp_path, path)
+    return meta
@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+
+# negatives share the author key of the positive; fall back to the same stock when the author has none
+BPR_KEY_SETS = [['item_author_cate', 'article_author', 'article_source_cate'], ['stock_code']]
+
+def group_ids(data, key_cols):
+    # dense group id per row over key_cols, -1 when any key is missing (nan never matches under ==)
+    gid = np.zeros(len(data), dtype=np.int64)
+    valid = np.ones(len(data), dtype=bool)
+    for col in key_cols:
+        codes, uniques = pd.factorize(data[col])
+        valid &= codes >= 0
+        gid, _ = pd.factorize(gid * (len(uniques)+1) + codes)
+    gid[~valid] = -1
+    return gid
+
+def negative_candidates(data, pos_mask, neg_mask, key_sets=BPR_KEY_SETS):
+    """
+    Negative candidates of every positive row, found with one grouped lookup per key set.
+    A positive takes the candidates of the first key set that gives it any.
+    returns pos_rows, and for each positive the start/count of its candidates in the returned pool of negative row ids
+    """
+    pos_rows = np.flatnonzero(pos_mask)
+    start = np.zeros(len(pos_rows), dtype=np.int64)
+    count = np.zeros(len(pos_rows), dtype=np.int64)
+    pools, base = [], 0
+    for key_cols in key_sets:
+        gid = group_ids(data, key_cols)
+        neg_rows = np.flatnonzero(neg_mask & (gid >= 0))
+        order = neg_rows[np.argsort(gid[neg_rows], kind='stable')] # negatives grouped by key
+        group_counts = np.bincount(gid[neg_rows], minlength=gid.max(initial=-1)+2)
+        group_offsets = np.concatenate([[0], np.cumsum(group_counts)])
+
+        todo = np.flatnonzero(count == 0)
+        g = gid[pos_rows[todo]]
+        has_key = g >= 0
+        count[todo] = np.where(has_key, group_counts[g], 0)
+        start[todo] = np.where(has_key, group_offsets[g], 0) + base
+
+        pools.append(order)
+        base += len(order)
+    return pos_rows, start, count, np.concatenate(pools)
+
+def filled_candidates(data, pos_mask, neg_mask, key_cols, fill_key_sets, k=3, seed=666):
+    """
+    Negative candidates as the sample_bpr notebook step matches them: the negatives sharing key_cols with a positive.
+    A positive with fewer than k of those also gets up to k random negatives of every key set in fill_key_sets
+    (drawn once, seeded), and the union, without duplicates, becomes a candidate list of its own.
+    returns pos_rows, start, count, pool as negative_candidates
+    """
+    rng = np.random.default_rng(seed)
+    pos_rows, start, count, pool = negative_candidates(data, pos_mask, neg_mask, [key_cols])
+    short = np.flatnonzero(count < k)
+    if not len(short):
+        return pos_rows, start, count, pool
+
+    # key_cols matches of the short positives (all of them, fewer than k) and up to k of every fill key set
+    short_mask = np.zeros(len(data), dtype=bool)
+    short_mask[pos_rows[short]] = True
+    pos_parts, row_parts = [], []
+    for key_set in [key_cols] + fill_key_sets:
+        _, key_start, key_count, key_pool = negative_candidates(data, short_mask, neg_mask, [key_set])
+        pos, slot = draw_negatives(key_start, key_count, k, rng)
+        pos_parts.append(short[pos])
+        row_parts.append(key_pool[slot])
+
+    # union per positive, appended to the pool as one segment each
+    pair = np.unique(np.concatenate(pos_parts) * len(data) + np.concatenate(row_parts)) # by positive, then row
+    pos, rows = pair // len(data), pair % len(data)
+    fill_count = np.bincount(pos, minlength=len(pos_rows))[short]
+    start[short] = len(pool) + np.cumsum(fill_count) - fill_count
+    count[short] = fill_count
+    return pos_rows, start, count, np.concatenate([pool, rows])
+
+def segment_cum_weights(scores, start, count):
+    """
+    Candidate weights exp(score - max score of the segment) over the pool, as inclusive cumulative sums restarting
+    at every candidate segment [start, start+count), for weighted_slots. Segments of different positives are either
+    the same or disjoint. Normalizing and summing inside each segment keeps the draw exact for a low-scoring segment
+    next to high-scoring ones, which one running sum over the pool would round away.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    if not len(scores):
+        return scores
+    used = count > 0
+    # pieces between segment bounds: each one a whole segment or pool positions no positive draws from
+    bounds = np.unique(np.concatenate([[0], start[used], (start+count)[used]]))
+    bounds = bounds[bounds < len(scores)]
+    piece = np.repeat(np.arange(len(bounds)), np.diff(np.append(bounds, len(scores))))
+    weight = np.exp(scores - np.maximum.reduceat(scores, bounds)[piece])
+    return pd.Series(weight).groupby(piece).cumsum().to_numpy()
+
+def weighted_slots(start, count, u, cum_weight):
+    # pool positions drawn in proportion to weight inside each [start, start+count) segment, for uniform u in [0,1)
+    # cum_weight holds the per-segment inclusive cumulative sums (segment_cum_weights): binary search inside each
+    # segment for the first position whose sum exceeds u times the segment total
+    start, count, u = np.broadcast_arrays(start, count, u)
+    lo, hi = start.copy(), start + count - 1
+    target = u * cum_weight[hi]
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        right = active & (cum_weight[mid] <= target)
+        lo = np.where(right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+        active = lo < hi
+    return lo
+
+def draw_negatives(start, count, k, rng, cum_weight=None):
+    """
+    Draw up to k distinct candidates per positive in bulk: all of them when count<=k, otherwise k without replacement.
+    With cum_weight (see segment_cum_weights) positives with more than k candidates instead draw k with replacement,
+    in proportion to the candidate weights.
+    returns (positive index, pool position) pairs, ordered by positive
+    """
+    # take all candidates
+    take_all = np.flatnonzero((count > 0) & (count <= k))
+    all_pos = np.repeat(take_all, count[take_all])
+    seg_start = np.repeat(np.cumsum(count[take_all]) - count[take_all], count[take_all])
+    all_slot = np.repeat(start[take_all], count[take_all]) + np.arange(len(all_pos)) - seg_start
+
+    if cum_weight is not None:
+        many = np.flatnonzero(count > k)
+        pick = weighted_slots(start[many][:, None], count[many][:, None], rng.random((len(many), k)), cum_weight)
+        pos = np.concatenate([all_pos, np.repeat(many, k)])
+        slot = np.concatenate([all_slot, pick.ravel()])
+        order = np.argsort(pos, kind='stable')
+        return pos[order], slot[order]
+
+    # small pools (k<count<=2k): pick the k smallest random keys
+    small = np.flatnonzero((count > k) & (count <= 2*k))
+    keys = rng.random((len(small), 2*k))
+    keys[np.arange(2*k)[None, :] >= count[small][:, None]] = np.inf
+    small_pick = np.argpartition(keys, k-1, axis=1)[:, :k] if len(small) else np.zeros((0, k), dtype=np.int64)
+
+    # large pools: draw with replacement and redraw the duplicates until every row is distinct
+    large = np.flatnonzero(count > 2*k)
+    large_pick = (rng.random((len(large), k)) * count[large][:, None]).astype(np.int64)
+    while len(large):
+        order = np.argsort(large_pick, axis=1, kind='stable')
+        srt = np.take_along_axis(large_pick, order, axis=1)
+        dup = np.zeros_like(large_pick, dtype=bool)
+        np.put_along_axis(dup, order[:, 1:], srt[:, 1:] == srt[:, :-1], axis=1)
+        if not dup.any():
+            break
+        rows = np.nonzero(dup)[0]
+        large_pick[dup] = (rng.random(len(rows)) * count[large][rows]).astype(np.int64)
+
+    pos = np.concatenate([all_pos, np.repeat(small, k), np.repeat(large, k)])
+    slot = np.concatenate([all_slot,
+                           (start[small][:, None] + small_pick).ravel(),
+                           (start[large][:, None] + large_pick).ravel()])
+    order = np.argsort(pos, kind='stable')
+    return pos[order], slot[order]
+
+def sample_bpr_pairs(data, neg_sample_num=10, tar_col='viral', key_sets=BPR_KEY_SETS, seed=666):
+    """
+    Pair every positive row of `data` with up to neg_sample_num negatives (see negative_candidates for the matching rule).
+    returns an int64 n*2 array of (pos row, neg row) positions in `data`
+    """
+    rng = np.random.default_rng(seed)
+    label = data[tar_col].to_numpy()
+    pos_rows, start, count, pool = negative_candidates(data, label == 1, label == 0, key_sets)
+    pos, slot = draw_negatives(start, count, neg_sample_num, rng)
+    print(f"sampled {len(pos)} bpr pairs; {(count==0).sum()} of {len(pos_rows)} positives have no negative")
+    return np.stack([pos_rows[pos], pool[slot]], axis=1)
@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+
+import torch
+from torch.utils.data import Dataset
+
+from dataset.negsampler import draw_negatives, weighted_slots, segment_cum_weights
+
+class BprPairData(Dataset):
+    """
+    BPR training pairs stored normalized: one table of unique posts (self.posts, a tuple of tensors
+    with one row per post, e.g. text n*2*len and the feature blocks) and an int32 n_pairs*2
+    (pos_idx, neg_idx) array into it (self.pairs). Subclasses fill both in __init__.
+    """
+    def __len__(self):
+        return len(self.pairs)
+
+    def __getitem__(self, idx):
+        pair = self.pairs[idx].long()
+        pos_idx, neg_idx = pair[..., 0], pair[..., 1]
+        return tuple(x[pos_idx] for x in self.posts), tuple(x[neg_idx] for x in self.posts)
+
+    def __getitems__(self, indices):
+        # fetch a whole batch with one gather per tensor, use with batch_collate
+        return self.__getitem__(torch.as_tensor(indices))
+
+    def get_post_num(self):
+        return len(self.posts[0])
+
+    def get_text_lengths(self):
+        # per pair, the longer of the pos and neg title
+        post_len = self.posts[0][:, 1].sum(dim=1)
+        pair = self.pairs.long()
+        return torch.maximum(post_len[pair[:, 0]], post_len[pair[:, 1]]).numpy()
+
+
+def normalize_pairs(data, cols, neg_prefix='neg_'):
+    """
+    Split a denormalized bpr frame (pos columns `cols` and the same columns prefixed with neg_prefix on every line)
+    into a frame of unique posts and an int32 n*2 (pos_idx, neg_idx) array into it.
+    """
+    pos = data[cols]
+    neg = data[[neg_prefix+x for x in cols]].set_axis(cols, axis=1)
+    stacked = pd.concat([pos, neg], ignore_index=True)
+
+    codes, _ = pd.factorize(pd.util.hash_pandas_object(stacked, index=False))
+    _, first_idx = np.unique(codes, return_index=True) # codes follow first appearance order
+    posts = stacked.iloc[first_idx].reset_index(drop=True)
+
+    pairs = np.stack([codes[:len(data)], codes[len(data):]], axis=1).astype(np.int32)
+    return posts, pairs
+
+
+class BprResampledData(BprPairData):
+    """
+    BPR pairs with the negatives redrawn every epoch. Keeps the pointwise post table and, for every positive post,
+    its negative candidates (pos_idx, start, count into pool, see dataset.negsampler.negative_candidates).
+    Each positive gets min(count, neg_sample_num) pairs per epoch; call set_epoch(epoch) before iterating.
+    With sample_in_workers the draw happens per batch inside the DataLoader workers instead of up front
+    (negatives of one positive are then drawn independently, so they may repeat within an epoch).
+    set_neg_scores switches the random draw to hard-negative mining: candidates are drawn in proportion to
+    exp(score/temperature) instead of uniformly.
+    """
+    def __init__(self, posts, candidates, neg_sample_num=10, seed=666, sample_in_workers=False):
+        self.posts = posts
+        self.pos_idx, self.start, self.count, self.pool = candidates
+        self.neg_sample_num = neg_sample_num
+        self.seed = seed
+        self.sample_in_workers = sample_in_workers
+
+        # one slot per pair: positives with few candidates take their j-th candidate in slot j, the rest draw at random
+        slots = np.minimum(self.count, neg_sample_num)
+        self.slot_pos = torch.from_numpy(np.repeat(self.pos_idx, slots).astype(np.int64))
+        self.slot_start = np.repeat(self.start, slots)
+        self.slot_count = np.repeat(self.count, slots)
+        rank = np.arange(slots.sum()) - np.repeat(np.cumsum(slots)-slots, slots)
+        self.slot_rank = np.where(self.slot_count <= neg_sample_num, rank, -1)
+
+        # shared memory, so DataLoader workers (persistent ones included) see what set_epoch/set_neg_scores write
+        self.epoch = torch.zeros(1, dtype=torch.long).share_memory_()
+        self.pairs = torch.zeros((len(self.slot_pos), 2), dtype=torch.int32).share_memory_()
+        self.weighted = torch.zeros(1, dtype=torch.bool).share_memory_()
+        self.cum_weight = torch.zeros(len(self.pool), dtype=torch.float64).share_memory_()
+        self.set_epoch(0)
+        print(f"{len(self.pairs)} bpr pairs per epoch from {(self.count>0).sum()} positives")
+
+    def get_text_lengths(self):
+        if self.sample_in_workers: # negatives are only known inside the workers, bucket on the positives
+            return self.posts[0][:, 1].sum(dim=1)[self.slot_pos].numpy()
+        return super().get_text_lengths()
+
+    def get_neg_candidates(self):
+        # post ids that can be drawn as a negative
+        return np.unique(self.pool)
+
+    def set_neg_scores(self, post_ids, scores, temperature=1.0):
+        # hard-negative mining: draw candidates in proportion to exp(score/temperature), takes effect from the next set_epoch
+        # normalized per candidate segment (see segment_cum_weights), unscored posts rank with the lowest score
+        scores = np.asarray(scores, dtype=np.float64) / temperature
+        post_scores = np.full(len(self.posts[0]), scores.min() if len(scores) else 0.)
+        post_scores[post_ids] = scores
+        self.cum_weight.copy_(torch.from_numpy(segment_cum_weights(post_scores[self.pool], self.start, self.count)))
+        self.weighted[0] = True
+
+    def set_epoch(self, epoch):
+        self.epoch[0] = epoch
+        if not self.sample_in_workers:
+            rng = np.random.default_rng([self.seed, epoch])
+            cum_weight = self.cum_weight.numpy() if self.weighted[0] else None
+            pos, slot = draw_negatives(self.start, self.count, self.neg_sample_num, rng, cum_weight)
+            self.pairs.copy_(torch.from_numpy(np.stack([self.pos_idx[pos], self.pool[slot]], axis=1).astype(np.int32)))
+
+    def __getitem__(self, idx):
+        if not self.sample_in_workers:
+            return super().__getitem__(idx)
+
+        idx = torch.as_tensor(idx)
+        flat = idx.reshape(-1).numpy()
+        rng = np.random.default_rng([self.seed, int(self.epoch[0]), int(flat[0]) if len(flat) else 0])
+        start, count, rank = self.slot_start[flat], self.slot_count[flat], self.slot_rank[flat]
+        if self.weighted[0]:
+            draw = weighted_slots(start, count, rng.random(len(flat)), self.cum_weight.numpy())
+        else:
+            draw = start + (rng.random(len(flat)) * count).astype(np.int64)
+        neg_idx = torch.from_numpy(self.pool[np.where(rank >= 0, start + rank, draw)]).reshape(idx.shape)
+        pos_idx = self.slot_pos[idx]
+        return tuple(x[pos_idx] for x in self.posts), tuple(x[neg_idx] for x in self.posts)
@@ -0,0 +1,65 @@
+import torch
+
+def to_device(batch, device, non_blocking=False):
+    # nested tuples/lists of tensors to device; tensors already on it are returned as they are
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(to_device(x, device, non_blocking) for x in batch)
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    return batch
+
+def _tensors(batch):
+    if isinstance(batch, (tuple, list)):
+        for x in batch:
+            yield from _tensors(x)
+    elif isinstance(batch, torch.Tensor):
+        yield batch
+
+class DevicePrefetcher():
+    """
+    Wraps a DataLoader to move every batch to `device` one batch ahead of the loop: the non-blocking copy of
+    batch i+1 is issued before batch i is handed over, so it runs while the step on batch i computes (on cuda
+    on a side stream). The models' own .to(device) calls are then no-ops. Copies only overlap from pinned
+    memory (--pin_memory). On cpu the batches pass through unchanged.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def preload(self, batch):
+        if self.stream is None:
+            return to_device(batch, self.device, non_blocking=True), None
+        with torch.cuda.stream(self.stream):
+            batch = to_device(batch, self.device, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        return batch, copied
+
+    def handover(self, batch, copied):
+        if copied is not None:
+            # compute waits for this batch's copy only, and the allocator must not reuse its memory before compute is done
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(copied)
+            for tensor in _tensors(batch):
+                tensor.record_stream(stream)
+        return batch
+
+    def __iter__(self):
+        if self.device.type == 'cpu':
+            yield from self.loader
+            return
+
+        batches = iter(self.loader)
+        ready = next(batches, None)
+        if ready is None:
+            return
+        ready = self.preload(ready)
+        for batch in batches:
+            upcoming = self.preload(batch)
+            yield self.handover(*ready)
+            ready = upcoming
+        yield self.handover(*ready)
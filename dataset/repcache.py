@@ -0,0 +1,23 @@
+import hashlib
+import torch
+
+from dataset.tensorstore import load_tensors
+
+def module_hash(module):
+    # content hash of a module's weights, so a cache built by other (e.g. fine-tuned) bert weights is never reused
+    h = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        h.update(name.encode('utf-8'))
+        h.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+def load_title_reps(text, model, batch_size=256):
+    """
+    Title representations (pooler_output, n*768 float32) of the token block text (n*2*len) from model.title_bert,
+    computed once per distinct titles and weights with model.encode_titles and kept in the memory-mapped tensor
+    store, for training with a frozen bert.
+    """
+    h = hashlib.sha1()
+    h.update(text.contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    key = hashlib.sha1('|'.join(['title_reps', h.hexdigest(), module_hash(model.title_bert)]).encode('utf-8')).hexdigest()[:20]
+    return load_tensors(key, lambda: {'reps': model.encode_titles(text, batch_size)})['reps']
@@ -0,0 +1,43 @@
+import numpy as np
+
+from torch.utils.data import Sampler, Subset
+
+def text_lengths(dataset):
+    # real title length of every sample (longest of the titles it carries), see get_text_lengths on the datasets
+    if isinstance(dataset, Subset):
+        return text_lengths(dataset.dataset)[np.asarray(dataset.indices)]
+    return np.asarray(dataset.get_text_lengths())
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler that puts titles of similar token length in the same batch, so trim_collate can cut most of the
+    padding. Samples are shuffled, cut into buckets of bucket_batches*batch_size, sorted by length inside each bucket
+    and split into batches; the batch order is shuffled again. Lengths are read on every pass, so datasets whose pairs
+    change per epoch (set_epoch) are bucketed on the current pairs.
+    """
+    def __init__(self, dataset, batch_size, shuffle=True, bucket_batches=100, seed=666):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        lengths = text_lengths(self.dataset)
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+
+        order = rng.permutation(len(lengths)) if self.shuffle else np.arange(len(lengths))
+        batches = []
+        for i in range(0, len(order), self.bucket_size):
+            bucket = order[i:i+self.bucket_size]
+            bucket = bucket[np.argsort(lengths[bucket], kind='stable')]
+            batches += [bucket[j:j+self.batch_size] for j in range(0, len(bucket), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[k] for k in rng.permutation(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
@@ -0,0 +1,93 @@
+import math
+import numpy as np
+
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from dataset.columnar import count_rows, read_rows
+
+class CsvStream(IterableDataset):
+    """
+    Rows of a csv read chunk_size at a time from its columnar bundle, encoded one chunk at a time (encode_chunk, in
+    subclasses) and yielded as ready-made batches (pack), so memory stays flat however long the file is: at most
+    buffer_size+chunk_size rows are held (the one-time conversion to the bundle parses the whole csv). With
+    buffer_size>0 rows pass through a shuffle buffer of that many rows, reshuffled every epoch (set_epoch). Use with
+    DataLoader(batch_size=None, num_workers=num_workers): every worker reads and encodes only every num_workers-th
+    chunk, and chunks are cut to at most a worker's share of the rows, so a short file (nrows) still feeds every worker.
+    """
+    def __init__(self, data_dir, usecols, batch_size=64, chunk_size=10000, buffer_size=0, nrows=None,
+                 num_workers=0, seed=666):
+        self.data_dir = data_dir
+        self.usecols = usecols
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.nrows = nrows
+        self.num_workers = max(num_workers, 1)
+        self.seed = seed
+        self.row_num = None
+        self.epoch = torch.zeros(1, dtype=torch.long).share_memory_() # seen by persistent workers too
+
+    def encode_chunk(self, chunk):
+        # dataframe chunk -> tuple of row-aligned tensors
+        raise NotImplementedError
+
+    def pack(self, rows):
+        # tuple of row-aligned tensors (one batch) -> batch in the shape the model expects
+        return rows
+
+    def set_epoch(self, epoch):
+        self.epoch[0] = epoch
+
+    def get_row_num(self):
+        # from the bundle's metadata, memoized
+        if self.row_num is None:
+            row_num = count_rows(self.data_dir)
+            self.row_num = row_num if self.nrows is None else min(row_num, self.nrows)
+        return self.row_num
+
+    def get_chunk_size(self):
+        return max(1, min(self.chunk_size, math.ceil(self.get_row_num()/self.num_workers)))
+
+    def chunk_starts(self):
+        return range(0, self.get_row_num(), self.get_chunk_size())
+
+    def __len__(self):
+        # batches per pass: every worker ends on its own partial batch
+        row_num, chunk_size = self.get_row_num(), self.get_chunk_size()
+        chunk_rows = [min(chunk_size, row_num-i) for i in self.chunk_starts()]
+        worker_rows = [sum(chunk_rows[w::self.num_workers]) for w in range(self.num_workers)]
+        return sum(math.ceil(rows/self.batch_size) for rows in worker_rows)
+
+    def shuffle(self, rows, rng):
+        if not self.buffer_size:
+            return rows
+        perm = torch.from_numpy(rng.permutation(len(rows[0])))
+        return tuple(x[perm] for x in rows)
+
+    def batches(self, rows):
+        for i in range(0, len(rows[0]), self.batch_size):
+            yield self.pack(tuple(x[i:i+self.batch_size].clone() for x in rows))
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker_id, num_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        rng = np.random.default_rng([self.seed, int(self.epoch[0]), worker_id])
+
+        row_num, chunk_size = self.get_row_num(), self.get_chunk_size()
+        buffer = None
+        for i, start in enumerate(self.chunk_starts()):
+            if i % num_workers != worker_id:
+                continue
+            rows = self.encode_chunk(read_rows(self.data_dir, start, min(start+chunk_size, row_num), usecols=self.usecols))
+            buffer = rows if buffer is None else tuple(torch.cat([b, r]) for b, r in zip(buffer, rows))
+
+            # hold buffer_size rows back for shuffling, emit whole batches of the rest
+            ready = (len(buffer[0]) - self.buffer_size) // self.batch_size * self.batch_size
+            if ready > 0:
+                buffer = self.shuffle(buffer, rng)
+                yield from self.batches(tuple(x[:ready] for x in buffer))
+                buffer = tuple(x[ready:] for x in buffer)
+
+        if buffer is not None and len(buffer[0]):
+            yield from self.batches(self.shuffle(buffer, rng))
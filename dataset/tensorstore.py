@@ -0,0 +1,67 @@
+"""
+Memory-mapped store for the tensors the datasets are built from (tokenized titles, feature matrices, pair and
+candidate indices): written once per source file and options as one .npy per tensor under STORE_DIR, then mapped
+copy-on-write by every process that needs them. Pages come from the OS page cache, so DataLoader workers and
+concurrent runs on the same data share one resident copy instead of each holding its own.
+"""
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+
+from dataset.tokencache import file_hash
+
+STORE_DIR = './data/tensor_store'
+STORE_VERSION = 1
+
+def transform_names(transforms):
+    # stable description of a transform list for store keys (the objects' reprs carry addresses)
+    return [type(t).__name__ for t in transforms] if transforms else []
+
+def store_key(source, **options):
+    # keyed on the source file content and everything else the stored tensors depend on
+    key = '|'.join([file_hash(source), str(STORE_VERSION)] + [f'{k}={options[k]!r}' for k in sorted(options)])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+def _map(path):
+    try:
+        values = np.load(path, mmap_mode='c')
+    except ValueError: # empty arrays cannot be mapped
+        values = np.load(path)
+    return torch.from_numpy(values)
+
+def load_tensors(key, build):
+    """
+    Dict of named tensors stored under `key` (see store_key), memory-mapped. On a miss build() is called for them
+    (a dict of tensors or arrays), the result is saved and mapped back, so the built copies are dropped.
+    Writing to a returned tensor only changes this process's copy of the touched pages.
+    """
+    path = os.path.join(STORE_DIR, key)
+    meta_file = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_file):
+        tensors = build()
+        tmp = path + f'.{os.getpid()}.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, values in tensors.items():
+            np.save(os.path.join(tmp, f'{name}.npy'), values.numpy() if isinstance(values, torch.Tensor) else np.asarray(values))
+        with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'version': STORE_VERSION, 'names': list(tensors)}, f)
+        del tensors
+
+        # swap the finished store in, so an interrupted build never leaves a partial one behind (meta.json is written
+        # last, so a swapped-in store is always complete). A concurrent build of the same key may have swapped its
+        # store in first: that one holds the same tensors, keep it and drop ours
+        try:
+            os.replace(tmp, path)
+            print(f"saved tensor store {path}")
+        except OSError:
+            if not os.path.exists(meta_file):
+                raise
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    with open(meta_file, encoding='utf-8') as f:
+        names = json.load(f)['names']
+    return {name: _map(os.path.join(path, f'{name}.npy')) for name in names}
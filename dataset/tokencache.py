@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from tqdm import tqdm
+
+from transformers import AutoTokenizer, BertTokenizer
+
+from dataset.columnar import bundle_path
+
+CACHE_DIR = './data/token_cache'
+
+_hash_memo = {}
+_tokenizers = {}
+
+def _sha1_file(path, chunk_size):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_hash(path, chunk_size=1<<20):
+    """
+    Content hash of a source file, so edited/regenerated csvs never hit a stale cache. The hash is kept in a
+    <path>.sha1 sidecar with the size and mtime it was computed at, so a file is hashed once rather than by every
+    process start. Without the csv (only its columnar bundle shipped) the size/mtime recorded in the bundle are used:
+    a sidecar shipped along still gives the csv's hash, otherwise the key is the bundle's meta.json.
+    """
+    bundle_meta = None
+    if os.path.exists(path):
+        stat = os.stat(path)
+        size, mtime_ns = stat.st_size, stat.st_mtime_ns
+    else:
+        with open(os.path.join(bundle_path(path), 'meta.json'), 'rb') as f:
+            bundle_meta = f.read()
+        meta = json.loads(bundle_meta)
+        size, mtime_ns = meta['source_size'], meta['source_mtime_ns']
+
+    memo_key = (os.path.abspath(path), size, mtime_ns)
+    if memo_key not in _hash_memo:
+        sidecar = path + '.sha1'
+        try:
+            with open(sidecar, encoding='utf-8') as f:
+                memo = json.load(f)
+            digest = memo['sha1'] if (memo['size'], memo['mtime_ns']) == (size, mtime_ns) else None
+        except (OSError, ValueError, KeyError):
+            digest = None
+        if digest is None and bundle_meta is not None:
+            digest = hashlib.sha1(bundle_meta).hexdigest()
+        elif digest is None:
+            digest = _sha1_file(path, chunk_size)
+            try: # best effort, e.g. read-only data dirs just hash again next time
+                tmp = sidecar + f'.{os.getpid()}.tmp'
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump({'size': size, 'mtime_ns': mtime_ns, 'sha1': digest}, f)
+                os.replace(tmp, sidecar)
+            except OSError:
+                pass
+        _hash_memo[memo_key] = digest
+    return _hash_memo[memo_key]
+
+def cache_key(source, bert, max_padding_len, tag=''):
+    key = '|'.join([file_hash(source), bert, str(max_padding_len), tag])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+# chunk of titles per tokenizer call, and processes used when no fast tokenizer is available
+TOKENIZE_CHUNK = 4096
+TOKENIZE_WORKERS = os.cpu_count() or 1
+
+def load_tokenizer(bert, fast=True):
+    # one tokenizer per process and bert version; the fast (rust) tokenizer spreads a batch call over all cores
+    if (bert, fast) not in _tokenizers:
+        _tokenizers[(bert, fast)] = AutoTokenizer.from_pretrained(bert, use_fast=True) if fast else BertTokenizer.from_pretrained(bert)
+    return _tokenizers[(bert, fast)]
+
+def tokenize_batch(texts, bert, max_padding_len, fast=True):
+    # tokenize a block of titles in one tokenizer call: input_ids (int32) and attention_mask (int8), n*max_padding_len
+    encoded = load_tokenizer(bert, fast)(list(texts),
+                                         add_special_tokens=True,
+                                         max_length=max_padding_len,
+                                         truncation=True,
+                                         padding='max_length',
+                                         return_attention_mask=True,
+                                         return_tensors='np')
+    return encoded['input_ids'].astype(np.int32), encoded['attention_mask'].astype(np.int8)
+
+def _tokenize_chunk(job):
+    texts, bert, max_padding_len = job
+    return tokenize_batch(texts, bert, max_padding_len, fast=False)
+
+def tokenize_titles(texts, bert, max_padding_len, desc=None, num_workers=None):
+    """
+    Tokenize texts in chunks of TOKENIZE_CHUNK with the batch tokenizer api. With the fast tokenizer the chunks run
+    in this process (the tokenizer itself is multi-threaded); without one they fan out over num_workers processes
+    (default TOKENIZE_WORKERS). Same ids and masks as encode_plus one string at a time.
+    """
+    texts = list(texts)
+    num_workers = num_workers or TOKENIZE_WORKERS
+    chunks = [texts[i:i+TOKENIZE_CHUNK] for i in range(0, len(texts), TOKENIZE_CHUNK)]
+    if desc:
+        print(desc)
+
+    fast = load_tokenizer(bert).is_fast
+    if fast or num_workers == 1 or len(chunks) <= 1:
+        encoded = [tokenize_batch(chunk, bert, max_padding_len, fast) for chunk in tqdm(chunks)]
+    else:
+        with ProcessPoolExecutor(min(num_workers, len(chunks))) as pool:
+            jobs = [(chunk, bert, max_padding_len) for chunk in chunks]
+            encoded = list(tqdm(pool.map(_tokenize_chunk, jobs), total=len(chunks)))
+
+    if not encoded:
+        return np.zeros((0, max_padding_len), dtype=np.int32), np.zeros((0, max_padding_len), dtype=np.int8)
+    return np.concatenate([x[0] for x in encoded]), np.concatenate([x[1] for x in encoded])
+
+def encode_titles(texts, bert, max_padding_len, source=None, tag='', desc=None):
+    """
+    Tokenize titles for bert input: returns input_ids (int32) and attention_mask (int8), both n*max_padding_len.
+    If `source` (the file the titles were read from) is given, the result is cached on disk under
+    CACHE_DIR, keyed on the file content hash, bert name, max_padding_len and `tag`
+    (use the tag for anything else that changes the title list, e.g. column name or nrows).
+    """
+    if source is None:
+        return tokenize_titles(texts, bert, max_padding_len, desc)
+
+    key = cache_key(source, bert, max_padding_len, tag)
+    ids_path = os.path.join(CACHE_DIR, f'{key}_ids.npy')
+    mask_path = os.path.join(CACHE_DIR, f'{key}_mask.npy')
+
+    if os.path.exists(ids_path) and os.path.exists(mask_path):
+        input_ids, attention_masks = np.load(ids_path), np.load(mask_path)
+        if len(input_ids)==len(texts):
+            print(f"loaded cached tokens for {source} {tag} from {CACHE_DIR}")
+            return input_ids, attention_masks
+
+    input_ids, attention_masks = tokenize_titles(texts, bert, max_padding_len, desc)
+
+    # write to a temp file first so an interrupted run never leaves a truncated cache behind
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for path, arr in ((ids_path, input_ids), (mask_path, attention_masks)):
+        tmp_path = path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp_path, path)
+
+    return input_ids, attention_masks
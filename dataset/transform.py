@@ -1,9 +1,62 @@
 import torch
+import torch.nn.functional as F
+from torch.utils.data import default_collate
 
 # Converts a numpy array to a torch tensor
 class ToTensor(object):
     def __call__(self, data):
         return torch.tensor(data)
+
+# Apply a transform list once to a whole column block at dataset construction, so that
+# __getitem__ is a plain tensor slice
+def apply_transforms(data, transforms):
+    if transforms:
+        for trsfm in transforms:
+            data = trsfm(data)
+    return torch.as_tensor(data)
+
+# Collate for datasets that implement __getitems__: the batch is already gathered, so pass it through.
+# Falls back to default_collate when the DataLoader fetched items one by one (torch<2.1)
+def batch_collate(batch):
+    if isinstance(batch, list):
+        return default_collate(batch)
+    return batch
+
+# Dynamic padding: cut every title block (batch*2*len, ids and mask stacked) in a batch down to the longest real
+# title of the batch. Bert ignores masked positions, so the model output does not change
+def trim_text(batch):
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(trim_text(x) for x in batch)
+    if isinstance(batch, torch.Tensor) and batch.dim() == 3 and batch.shape[1] == 2:
+        return batch[:, :, :max(int(batch[:, 1].sum(dim=1).max()), 1)] if len(batch) else batch
+    return batch
+
+def trim_collate(batch):
+    return trim_text(batch_collate(batch))
+
+# Stack two batches of the same layout (bpr positives and negatives) into one, for a single forward pass. Title blocks
+# trimmed to different lengths are padded back to the longer one with masked positions, so bert output does not change
+def cat_batches(a, b):
+    if isinstance(a, (tuple, list)):
+        return type(a)(cat_batches(x, y) for x, y in zip(a, b))
+    if a.dim() == 3 and a.shape[1] == 2 and a.shape[2] != b.shape[2]:
+        length = max(a.shape[2], b.shape[2])
+        a, b = (F.pad(x, (0, length - x.shape[2])) for x in (a, b))
+    return torch.cat([a, b])
+
+# Rows of a batch: length of its first tensor
+def batch_len(batch):
+    return batch_len(batch[0]) if isinstance(batch, (tuple, list)) else len(batch)
+
+# Split a batch into micro-batches of at most ceil(rows/chunks) rows, the same rows of every tensor together (bpr
+# positives stay paired with their negatives), each micro-batch's title blocks trimmed to its own longest title
+def split_batch(batch, chunks):
+    size = max(-(-batch_len(batch) // chunks), 1)
+    def split(x):
+        if isinstance(x, (tuple, list)):
+            return [type(x)(parts) for parts in zip(*(split(y) for y in x))]
+        return torch.split(x, size)
+    return [trim_text(micro) for micro in split(batch)]
     
 # class TextInputToTensor(object):
 #     def __call__(self, data, index):
@@ -51,4 +104,4 @@ class Normalize(object):
 #         input_ids_content = torch.cat(input_ids_content, dim=0)
 #         attention_masks_content = torch.cat(attention_masks_content, dim=0)
 
-#         return input_ids_title, attention_masks_title, input_ids_content, attention_masks_content
\ No newline at end of file
+#         return input_ids_title, attention_masks_title, input_ids_content, attention_masks_content
@@ -10,10 +10,12 @@ Original file is located at
 
 # Load the required libraries
 import os
+import json
+import shutil
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
 import torch
-from transformers import BertTokenizer
+from dataset.tokencache import tokenize_titles
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import classification_report
 from models import Deep
@@ -26,9 +28,9 @@ percent = 5
 
 LOG_PATH = (f"./logs/deep_{mode}.log")
 logging.basicConfig(filename=LOG_PATH, filemode='w', level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-DATA_PATH = './data/feed_data.pt' 
-
-df = pd.read_csv('./data/processed_data.csv')
+SOURCE_PATH = './data/processed_data.csv'
+DATA_DIR = './data/feed_data' # inputs.npy (memory-mapped), labels.npy, meta.json
+TOPIC_COLS = ['Topic_1', 'Topic_2', 'Topic_3', 'Topic_4', 'Topic_5']
 
 device = 'cuda' # changable
 if device == 'cuda' and torch.cuda.is_available():
@@ -39,71 +41,79 @@ else:
     device = torch.device('cpu')
 logging.debug(f"Computing device: {device}")
 
-# parse inputs
-if os.path.isfile(DATA_PATH):
-    inputs, labels, author_index, company_index, sentiment_index = torch.load(DATA_PATH)
-
-else:
-    tokenizer = BertTokenizer.from_pretrained('bert-base-chinese')
-    df['Item_Author_f'], author_index = pd.factorize(df['Item_Author'])
-    df['Company_ID_f'], company_index = pd.factorize(df['Company_ID'])
-    df['sentiment_f'], sentiment_index = pd.factorize(df['sentiment'])
-
-    inputs = []
-    for index, row in tqdm(df.iterrows(), total=len(df)):
-        row_input = []
-        # news title [0-31], title mask [32-63]
-        title = row['Item_Title']
-        encoded_dict = tokenizer.encode_plus(title,
-                                            add_special_tokens=True,
-                                            max_length=32,
-                                            padding='max_length',
-                                            truncation=True,
-                                            # pad_to_max_length=True,
-                                            return_attention_mask=True,
-                                            return_tensors='pt')
-        row_input.append(encoded_dict['input_ids'].squeeze())
-        row_input.append(encoded_dict['attention_mask'].squeeze())
-        # news text [64-319], text mask [320-575]
-        text = row['news_text']
-        encoded_dict = tokenizer.encode_plus(text,
-                                            add_special_tokens=True,
-                                            max_length=256,
-                                            padding='max_length',
-                                            truncation=True,
-                                            # pad_to_max_length=True,
-                                            return_attention_mask=True,
-                                            return_tensors='pt')
-        row_input.append(encoded_dict['input_ids'].squeeze())
-        row_input.append(encoded_dict['attention_mask'].squeeze())
-        # author index [576]
-        author = row['Item_Author_f']
-        row_input.append(torch.tensor([author]))
-        # company index [577]
-        company = row['Company_ID_f']
-        row_input.append(torch.tensor([company]))
-        # sentiment index [578]
-        sentiment = row['sentiment_f']
-        row_input.append(torch.tensor([sentiment]))
-        # topic probability [579, 580, 581, 582, 583]
-        topics = row[['Topic_1', 'Topic_2', 'Topic_3', 'Topic_4', 'Topic_5']]
-        row_input.append(torch.tensor(topics).squeeze())
-        row_input = torch.cat(row_input, dim=0)
-        # print(row_input.shape) #[1,584]
-
-        inputs.append(row_input)
-
-    inputs = torch.cat(inputs).view(-1,len(row_input))
-    print(inputs.shape)
+def build_feed_data(data_dir):
+    """
+    Vectorized build of the model inputs, one row per post (n*584, float64 as before):
+    news title [0-31], title mask [32-63], news text [64-319], text mask [320-575],
+    author index [576], company index [577], sentiment index [578], topic probability [579-583].
+    inputs are filled column block by column block into a .npy written in place (open_memmap), next to the labels
+    and a meta.json with the factorized vocabularies and the source file it was built from.
+    """
+    df = pd.read_csv(SOURCE_PATH)
+    author_f, author_index = pd.factorize(df['Item_Author'])
+    company_f, company_index = pd.factorize(df['Company_ID'])
+    sentiment_f, sentiment_index = pd.factorize(df['sentiment'])
+
+    # tokenize every title and text up front with the shared batch tokenizer
+    title_ids, title_masks = tokenize_titles(df['Item_Title'].tolist(), 'bert-base-chinese', 32, desc="tokenize titles")
+    text_ids, text_masks = tokenize_titles(df['news_text'].tolist(), 'bert-base-chinese', 256, desc="tokenize news text")
+
+    blocks = [title_ids, title_masks, text_ids, text_masks, author_f[:, None], company_f[:, None], sentiment_f[:, None],
+              df[TOPIC_COLS].to_numpy(dtype=np.float64)]
+
+    # write to a temp dir first so an interrupted build never leaves a truncated one behind
+    tmp = data_dir + f'.{os.getpid()}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    inputs = np.lib.format.open_memmap(os.path.join(tmp, 'inputs.npy'), mode='w+', dtype=np.float64,
+                                       shape=(len(df), sum(b.shape[1] for b in blocks)))
+    col = 0
+    for block in blocks:
+        inputs[:, col:col+block.shape[1]] = block
+        col += block.shape[1]
+    inputs.flush()
+    del inputs
+    print(f"built inputs {len(df)}*{col}")
 
     # label
-    labels = torch.tensor(df[f'top{percent}p_views'].values)
+    np.save(os.path.join(tmp, 'labels.npy'), df[f'top{percent}p_views'].to_numpy())
+    stat = os.stat(SOURCE_PATH)
+    meta = {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns, 'percent': percent,
+            'author_index': author_index.tolist(), 'company_index': company_index.tolist(), 'sentiment_index': sentiment_index.tolist()}
+    with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.replace(tmp, data_dir)
+
+def load_feed_data(data_dir):
+    # (re)build if missing or built from another source file / label, then map the inputs instead of loading them
+    meta_file = os.path.join(data_dir, 'meta.json')
+    fresh = False
+    if os.path.exists(meta_file):
+        with open(meta_file, encoding='utf-8') as f:
+            meta = json.load(f)
+        stat = os.stat(SOURCE_PATH)
+        fresh = meta['percent'] == percent and meta['source_size'] == stat.st_size and meta['source_mtime_ns'] == stat.st_mtime_ns
+    if not fresh:
+        build_feed_data(data_dir)
+        with open(meta_file, encoding='utf-8') as f:
+            meta = json.load(f)
+
+    inputs = torch.from_numpy(np.load(os.path.join(data_dir, 'inputs.npy'), mmap_mode='c'))
+    labels = torch.from_numpy(np.load(os.path.join(data_dir, 'labels.npy')))
+    return inputs, labels, meta['author_index'], meta['company_index'], meta['sentiment_index']
+
+# parse inputs
+feed_inputs, feed_labels, author_index, company_index, sentiment_index = load_feed_data(DATA_DIR)
 
-    # save procussed data
-    torch.save((inputs, labels, author_index, company_index, sentiment_index), DATA_PATH)
+# split row indices (same split as splitting the rows), the mapped inputs are only read one batch at a time
+train_idx, validation_idx = train_test_split(np.arange(len(feed_inputs)), random_state=42, test_size=0.1)
 
-# split data
-train_inputs, validation_inputs, train_labels, validation_labels = train_test_split(inputs, labels, random_state=42, test_size=0.1)
+def feed_batch(idx):
+    # rows of a batch in file order, so the gather reads the map forward
+    idx = torch.from_numpy(np.sort(idx))
+    return feed_inputs[idx], feed_labels[idx]
 
 # setup model
 model = Deep(num_author=len(author_index), num_company=len(company_index), num_sentiment=len(sentiment_index), num_topic=5, hidden_size=64)
@@ -127,9 +137,8 @@ if mode == 'train':
     for epoch in range(epochs):
         model.train()
         train_loss = 0
-        for i in range(0, len(train_inputs), batch_size):
-            inputs = train_inputs[i:i+batch_size]
-            labels = train_labels[i:i+batch_size]
+        for i in range(0, len(train_idx), batch_size):
+            inputs, labels = feed_batch(train_idx[i:i+batch_size])
 
             inputs = inputs.to(device)
             labels = labels.to(device)
@@ -146,7 +155,7 @@ if mode == 'train':
             optimizer.step()
             if i%10000==0:
                 logging.debug(f"train:{i}, loss:{loss/len(batch_size)}")
-        logging.debug(f"train epoch:{epoch}, loss:{train_loss/len(train_inputs)}")
+        logging.debug(f"train epoch:{epoch}, loss:{train_loss/len(train_idx)}")
 
         torch.save(model.state_dict(),f"./models/deep_model_{percent}_{epoch}.pt")
 
@@ -157,7 +166,7 @@ elif mode == 'test':
         param = torch.load(f"./models/deep_model_{percent}_{epoch}.pt")
         model.load_state_dict(param)
         model.to(device)
-        logging.debug(f"data size: {len(validation_inputs)}")
+        logging.debug(f"data size: {len(validation_idx)}")
 
         # Evaluate the model on the validation set
         model.eval()
@@ -168,9 +177,8 @@ elif mode == 'test':
         true_labels = []
         # attention_weights = []
         with torch.no_grad():
-            for i in range(0, len(validation_inputs),batch_size):
-                inputs = validation_inputs[i:i+batch_size]
-                labels = validation_labels[i:i+batch_size]
+            for i in range(0, len(validation_idx),batch_size):
+                inputs, labels = feed_batch(validation_idx[i:i+batch_size])
 
                 inputs = inputs.to(device)
                 labels = labels.to(device)
@@ -203,8 +211,8 @@ elif mode == 'test':
                 
 
         # Calculate the accuracy and logging.debug the results
-        accuracy = num_correct / len(validation_labels)
-        logging.debug(f'Validation Loss: {eval_loss / len(validation_labels):.4f}, Validation Accuracy: {accuracy:.4f}')
+        accuracy = num_correct / len(validation_idx)
+        logging.debug(f'Validation Loss: {eval_loss / len(validation_idx):.4f}, Validation Accuracy: {accuracy:.4f}')
 
         # logging.debug classification report and confusion matrix
         logging.debug(f"\n{classification_report(true_labels, predictions)}")
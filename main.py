@@ -2,18 +2,23 @@
 
 from dataset.bertdata import BertData
 from dataset.bprdata import BprData
-from dataset.inc_bprdata import IncBprData, IncTestData
-from dataset.transform import ToTensor#, Log, random_split
+from dataset.inc_bprdata import IncBprData, IncResampledData, IncTestData, IncBprStream, IncTestStream
+from dataset.transform import ToTensor, batch_collate, trim_collate, trim_text, batch_len, split_batch#, Log, random_split
+from dataset.sampler import LengthBucketSampler
+from dataset.prefetch import DevicePrefetcher
+from dataset.repcache import load_title_reps
+from dataset.metadata import load_metadata
 from model_temps.lr import LR
 from model_temps.llr import LLR
 from model_temps.bert import Bert
 from model_temps.bertatt import BertAtt
 from model_temps.bertbpr import BertAttBpr
 from model_temps.incbertbpr import IncBertAttBpr
+from model_temps.compiled import CACHE_DIR, compile_forward
 
 import torch
 import atexit
-from torch.utils.data import DataLoader, random_split
+from torch.utils.data import DataLoader, IterableDataset, random_split
 
 import argparse
 import logging
@@ -22,7 +27,6 @@ import time
 import numpy as np
 import re
 import os
-import pickle
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -52,7 +56,34 @@ parser.add_argument('--oversample', type=bool, default=False, help="whether over
 parser.add_argument('--report', type=bool, default=True, help="whether generate report", required=False)
 parser.add_argument('--round', type=int, default=1, help="which round of v3 (continous training) is on", required=False)
 parser.add_argument('--drop', type=float, default=0.0, help="dropout rate for training model", required=False)
+parser.add_argument('--resample', action='store_true', help="redraw bpr negatives every epoch (BertBpr* models)", required=False)
+parser.add_argument('--resample_in_workers', action='store_true', help="with --resample, draw negatives per batch inside DataLoader workers", required=False)
+parser.add_argument('--hard_neg', type=int, default=0, help="with --resample (BertBpr_v3), mine hard negatives by model score every n epochs, 0 is off", required=False)
+parser.add_argument('--hard_neg_temp', type=float, default=1.0, help="temperature of the score-proportional hard negative draw", required=False)
+parser.add_argument('--nrows', type=int, default=None, help="rows read from each csv (Bert, BertAtt, BertBpr_v3), default keeps the loaders' caps, 0 reads all rows", required=False)
+parser.add_argument('--stream', action='store_true', help="BertBpr_v3: stream the csvs in chunks from their columnar bundles instead of loading them, no row cap and flat memory", required=False)
+parser.add_argument('--stream_buffer', type=int, default=10000, help="with --stream, rows in the shuffle buffer of the training data", required=False)
+parser.add_argument('--workers', type=int, default=0, help="DataLoader worker processes for every loader, 0 loads in the main process", required=False)
+parser.add_argument('--pin_memory', action='store_true', help="pin loaded batches for faster host to gpu copies", required=False)
+parser.add_argument('--prefetch', type=int, default=2, help="with --workers, batches prefetched by each worker", required=False)
+parser.add_argument('--persistent_workers', action='store_true', help="with --workers, keep the workers alive across epochs", required=False)
+parser.add_argument('--freeze_bert', action='store_true', help="BertBpr_v3: freeze bert and train the heads from title representations computed once and cached on disk", required=False)
+parser.add_argument('--bucket', action='store_true', help="batch titles of similar length together in the train/valid loaders (padding is trimmed per batch either way)", required=False)
+parser.add_argument('--precision', choices=['fp32', 'bf16', 'fp16'], default='fp32', help="autocast precision of the model forwards in training and evaluation, bf16 for cpus with native bf16 matmul", required=False)
+parser.add_argument('--compile', action='store_true', help="run the model forward compiled with torch.compile, the compiled graphs are cached across runs in --compile_cache", required=False)
+parser.add_argument('--compile_cache', type=str, default=CACHE_DIR, help="with --compile, directory of the compiled graph and kernel caches", required=False)
+parser.add_argument('--accum_steps', type=int, default=1, help="split each --batch training batch into this many micro-batches and accumulate their gradients before one optimizer step", required=False)
+parser.add_argument('--hard_neg_refresh', type=int, default=0, help="re-encode cached candidate titles every n mining rounds, 0 keeps the first encoding", required=False)
 args = parser.parse_args()
+# hard negatives are mined by IncBertAttBpr.score_posts into the per-epoch draw of the resampled v3 data
+if args.hard_neg and not (args.model == 'BertBpr_v3' and args.resample):
+    parser.error("--hard_neg needs --model=BertBpr_v3 with --resample")
+if args.stream and args.model != 'BertBpr_v3':
+    parser.error("--stream needs --model=BertBpr_v3")
+if args.freeze_bert and args.model != 'BertBpr_v3':
+    parser.error("--freeze_bert needs --model=BertBpr_v3")
+if args.freeze_bert and args.stream:
+    parser.error("--freeze_bert caches title representations per post table, use it without --stream")
 
 #Configure logging
 LOG_PATH = (f"./logs/{args.model}_{args.batch}_{args.lr}_{args.dim}_{args.optim}_{args.drop}_{args.comment}.log")
@@ -60,6 +91,9 @@ logging.basicConfig(filename=LOG_PATH, filemode='w', level=logging.DEBUG, format
 
 MODEL_PATH = (f"./models/{args.model}_{args.batch}_{args.lr}_{args.dim}_{args.optim}_{args.drop}_{args.comment}.pt")
 
+# row cap passed to the in-memory loaders, when given on the command line
+nrows_kw = {} if args.nrows is None else {'nrows': args.nrows or None}
+
 print("="*20 + "START PROGRAM" + "="*20)
 
 #1. Configure device
@@ -71,6 +105,37 @@ else:
     device = torch.device('cpu')
 print(f"Computing device: {device}")
 
+# --precision: forwards under autocast (matmuls in bf16/fp16, reductions and losses in fp32), fp16 with loss scaling
+amp_dtype = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[args.precision]
+def autocast():
+    return torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None)
+
+def has_title_tokens(dataset):
+    # post tables whose titles were swapped for cached bert representations (--freeze_bert) carry no padding to bucket
+    posts = getattr(dataset, 'posts', None)
+    return posts is None or not posts[0].is_floating_point()
+
+def make_loader(dataset, trim=False):
+    """
+    DataLoader over whole batches (streams already yield them), with the --workers/--pin_memory/--prefetch/
+    --persistent_workers settings. trim cuts title padding down to the longest title of each batch, and with --bucket
+    titles of similar length are batched together: train/valid loaders only, eval concatenates title attention
+    across test batches.
+    Datasets only hold tensors, which workers share rather than copy.
+    """
+    loader_args = {'num_workers': args.workers, 'pin_memory': args.pin_memory}
+    if args.workers > 0:
+        loader_args.update(prefetch_factor=args.prefetch, persistent_workers=args.persistent_workers)
+
+    if isinstance(dataset, IterableDataset):
+        loader = DataLoader(dataset, batch_size=None, collate_fn=trim_text if trim else None, **loader_args)
+    elif trim and args.bucket and has_title_tokens(dataset):
+        loader = DataLoader(dataset, batch_sampler=LengthBucketSampler(dataset, args.batch, shuffle=True), collate_fn=trim_collate, **loader_args)
+    else:
+        loader = DataLoader(dataset, batch_size=args.batch, shuffle=True, collate_fn=trim_collate if trim else batch_collate, **loader_args)
+    # batches arrive on the device, the next one copied while the current step runs
+    return DevicePrefetcher(loader, device)
+
 #2. Load data
 if args.model=='Bert' or args.model=='BertAtt':
     x_trans_list = [ToTensor()]
@@ -94,17 +159,18 @@ if args.model=='Bert' or args.model=='BertAtt':
                     max_padding_len=args.pad_len,
                     x_transforms=x_trans_list,\
                     y_transforms=y_trasn_list,
-                    bert = args.bert)
+                    bert = args.bert,
+                    **nrows_kw)
     gen = torch.Generator()
     gen.manual_seed(666)
     train_data, valid_data, test_data = random_split(data, [0.8,0.1,0.1], generator=gen) #train:valid:test = 8:1:1
     # print(train_data[0][1])
     # exit()                    
 
-    train_dataloader = DataLoader(train_data, batch_size=args.batch, shuffle=True)
-    valid_dataloader = DataLoader(valid_data, batch_size=args.batch, shuffle=True)
+    train_dataloader = make_loader(train_data, trim=True)
+    valid_dataloader = make_loader(valid_data)
     valid_dataset = valid_dataloader
-    test_dataloader = DataLoader(test_data, batch_size=args.batch, shuffle=True)    
+    test_dataloader = make_loader(test_data)
     test_dataset = test_dataloader         
                                                                                     
 elif args.model=='BertBpr':
@@ -128,15 +194,17 @@ elif args.model=='BertBpr':
                     tar_col = 'viral',
                     max_padding_len=args.pad_len,
                     x_transforms=x_trans_list,
-                    bert = args.bert)
+                    bert = args.bert,
+                    resample=args.resample,
+                    sample_in_workers=args.resample_in_workers)
                                                                    
     train_data = data.train_data
     valid_data = data.valid_data
     test_data = data.test_data
 
-    train_dataloader = DataLoader(train_data, batch_size=args.batch, shuffle=True)
-    valid_dataloader = DataLoader(valid_data, batch_size=args.batch, shuffle=True)
-    test_dataloader = DataLoader(test_data, batch_size=args.batch, shuffle=True)
+    train_dataloader = make_loader(train_data, trim=True)
+    valid_dataloader = make_loader(valid_data, trim=True)
+    test_dataloader = make_loader(test_data)
     valid_dataset = test_dataset = (valid_dataloader, test_dataloader)
 
 elif args.model=='BertBpr_v2':
@@ -161,15 +229,17 @@ elif args.model=='BertBpr_v2':
                     tar_col = 'viral',
                     max_padding_len=args.pad_len,
                     x_transforms=x_trans_list,
-                    bert = args.bert)
+                    bert = args.bert,
+                    resample=args.resample,
+                    sample_in_workers=args.resample_in_workers)
                                                                    
     train_data = data.train_data
     valid_data = data.valid_data
     test_data = data.test_data
 
-    train_dataloader = DataLoader(train_data, batch_size=args.batch, shuffle=True)
-    valid_dataloader = DataLoader(valid_data, batch_size=args.batch, shuffle=True)
-    test_dataloader = DataLoader(test_data, batch_size=args.batch, shuffle=True)
+    train_dataloader = make_loader(train_data, trim=True)
+    valid_dataloader = make_loader(valid_data, trim=True)
+    test_dataloader = make_loader(test_data)
     valid_dataset = test_dataset = (valid_dataloader, test_dataloader)
 
 elif args.model=='BertBpr_datagen': ##For data generation only
@@ -204,9 +274,9 @@ elif args.model=='BertBpr_datagen': ##For data generation only
     valid_data = data.valid_data
     test_data = data.test_data
 
-    train_dataloader = DataLoader(train_data, batch_size=args.batch, shuffle=True)
-    valid_dataloader = DataLoader(valid_data, batch_size=args.batch, shuffle=True)
-    test_dataloader = DataLoader(test_data, batch_size=args.batch, shuffle=True)
+    train_dataloader = make_loader(train_data, trim=True)
+    valid_dataloader = make_loader(valid_data, trim=True)
+    test_dataloader = make_loader(test_data)
     
     print(f"Data Generation complete. Training data: {len(train_data)}; Valid data: {len(valid_data)}; Testing data: {len(test_data)} \n Exit Program...")
     exit()
@@ -224,88 +294,99 @@ elif args.model=='BertBpr_v3': #continuous training #python main.py --model=Bert
                 'item_author_index_rank',
                 'article_author_index_rank',
                 'article_source_index_rank',]
-    
-    
-    
-    
-                                                                   
-    if args.round==1:
-        train_data = IncBprData(data_dir='./data/train_bpr1.csv', 
-                                post_cols=post_cols,
-                                author_cols=author_cols,
-                                tar_col = 'viral',
-                                max_padding_len=args.pad_len,
-                                x_transforms=x_trans_list,
-                                bert = args.bert)
-        valid_data = IncBprData(data_dir='./data/valid_bpr.csv',
-                                post_cols=post_cols,
-                                author_cols=author_cols,
-                                tar_col = 'viral',
-                                max_padding_len=args.pad_len,
-                                x_transforms=x_trans_list,
-                                bert = args.bert)
-        test_data = IncTestData(data_dir='./data/test1.csv',
+
+    # pointwise split each round's train_bpr file was sampled from, used by --resample
+    pointwise_train_dir = {1: './data/train1.csv', 2: './data/test1.csv', 3: './data/test2.csv', 4: './data/test3.csv'}
+    # earlier splits whose negatives were in that sampling pool too (round 4 as train_bpr4 was sampled, without test2)
+    pointwise_ref_dirs = {1: [],
+                          2: ['./data/train1.csv', './data/valid1.csv'],
+                          3: ['./data/train1.csv', './data/valid1.csv', './data/test1.csv'],
+                          4: ['./data/train1.csv', './data/valid1.csv', './data/test1.csv']}
+    def load_train_data(bpr_dir):
+        if args.resample:
+            return IncResampledData(data_dir=pointwise_train_dir[args.round],
+                                    post_cols=post_cols,
+                                    author_cols=author_cols,
+                                    tar_col = 'viral',
+                                    max_padding_len=args.pad_len,
+                                    x_transforms=x_trans_list,
+                                    bert = args.bert,
+                                    ref_dirs=pointwise_ref_dirs[args.round],
+                                    sample_in_workers=args.resample_in_workers)
+        return load_bpr_data(bpr_dir, buffer_size=args.stream_buffer)
+
+    def load_bpr_data(bpr_dir, buffer_size=0):
+        if args.stream:
+            return IncBprStream(data_dir=bpr_dir,
                                 post_cols=post_cols,
                                 author_cols=author_cols,
                                 tar_col = 'viral',
                                 max_padding_len=args.pad_len,
                                 x_transforms=x_trans_list,
-                                bert = args.bert)
+                                bert = args.bert,
+                                batch_size=args.batch,
+                                buffer_size=buffer_size,
+                                nrows=args.nrows or None,
+                                num_workers=args.workers)
+        return IncBprData(data_dir=bpr_dir,
+                          post_cols=post_cols,
+                          author_cols=author_cols,
+                          tar_col = 'viral',
+                          max_padding_len=args.pad_len,
+                          x_transforms=x_trans_list,
+                          bert = args.bert,
+                          **nrows_kw)
+
+    def load_test_data(test_dir):
+        if args.stream:
+            return IncTestStream(data_dir=test_dir,
+                                 post_cols=post_cols,
+                                 author_cols=author_cols,
+                                 tar_col = 'viral',
+                                 max_padding_len=args.pad_len,
+                                 x_transforms=x_trans_list,
+                                 bert = args.bert,
+                                 batch_size=args.batch,
+                                 nrows=args.nrows or None,
+                                 num_workers=args.workers)
+        return IncTestData(data_dir=test_dir,
+                           post_cols=post_cols,
+                           author_cols=author_cols,
+                           tar_col = 'viral',
+                           max_padding_len=args.pad_len,
+                           x_transforms=x_trans_list,
+                           bert = args.bert,
+                           **nrows_kw)
+
+                                                                   
+    if args.round==1:
+        train_data = load_train_data('./data/train_bpr1.csv')
+        valid_data = load_bpr_data('./data/valid_bpr.csv')
+        test_data = load_test_data('./data/test1.csv')
     elif args.round==2:
-        train_data = IncBprData(data_dir='./data/train_bpr2.csv',
-                                post_cols=post_cols,
-                                author_cols=author_cols,
-                                tar_col = 'viral',
-                                max_padding_len=args.pad_len,
-                                x_transforms=x_trans_list,
-                                bert = args.bert)
+        train_data = load_train_data('./data/train_bpr2.csv')
         valid_data = None
-        test_data = IncTestData(data_dir='./data/test2.csv',
-                                post_cols=post_cols,
-                                author_cols=author_cols,
-                                tar_col = 'viral',
-                                max_padding_len=args.pad_len,
-                                x_transforms=x_trans_list,
-                                bert = args.bert)
+        test_data = load_test_data('./data/test2.csv')
     elif args.round==3:
-        train_data = IncBprData(data_dir='./data/train_bpr3.csv',
-                                post_cols=post_cols,
-                                author_cols=author_cols,
-                                tar_col = 'viral',
-                                max_padding_len=args.pad_len,
-                                x_transforms=x_trans_list,
-                                bert = args.bert)
+        train_data = load_train_data('./data/train_bpr3.csv')
         valid_data = None
-        test_data = IncTestData(data_dir='./data/test3.csv',
-                                post_cols=post_cols,
-                                author_cols=author_cols,
-                                tar_col = 'viral',
-                                max_padding_len=args.pad_len,
-                                x_transforms=x_trans_list,
-                                bert = args.bert)
+        test_data = load_test_data('./data/test3.csv')
     elif args.round==4:
-        train_data = IncBprData(data_dir='./data/train_bpr4.csv',
-                                post_cols=post_cols,
-                                author_cols=author_cols,
-                                tar_col = 'viral',
-                                max_padding_len=args.pad_len,
-                                x_transforms=x_trans_list,
-                                bert = args.bert)
+        train_data = load_train_data('./data/train_bpr4.csv')
         valid_data = None
-        test_data = IncTestData(data_dir='./data/test4.csv',
-                                post_cols=post_cols,
-                                author_cols=author_cols,
-                                tar_col = 'viral',
-                                max_padding_len=args.pad_len,
-                                x_transforms=x_trans_list,
-                                bert = args.bert)
+        test_data = load_test_data('./data/test4.csv')
 
-    train_dataloader = DataLoader(train_data, batch_size=args.batch, shuffle=True)
-    valid_dataloader = DataLoader(valid_data, batch_size=args.batch, shuffle=True) if valid_data else None
-    test_dataloader = DataLoader(test_data, batch_size=args.batch, shuffle=True)
+    train_dataloader = make_loader(train_data, trim=True)
+    valid_dataloader = make_loader(valid_data, trim=True) if valid_data else None
+    test_dataloader = make_loader(test_data)
     valid_dataset = test_dataset = (valid_dataloader, test_dataloader)
 
-print(f"Data loaded. Training data: {len(train_data)}; Testing data: {len(test_data)}")
+def data_size(dataset):
+    # streams yield whole batches, so their len() is a batch count: report csv rows and batches instead
+    if isinstance(dataset, IterableDataset):
+        return f"{dataset.get_row_num()} csv rows in {len(dataset)} batches"
+    return f"{len(dataset)} samples"
+print(f"Data loaded. Training data: {data_size(train_data)}; Testing data: {data_size(test_data)}")
 
 #3. Select model
 if args.model == 'LR':
@@ -347,8 +428,10 @@ elif args.model == 'BertBpr' or args.model == 'BertBpr_v2':
                     device=device,
                     bert=args.bert).to(device)
 elif args.model == 'BertBpr_v3':
-    with open('./data/bpr_v3_meta.pkl', 'rb') as f:
-        post_ft_unique_count, author_ft_unique_count = pickle.load(f)
+    # embedding sizes (max code + 1) over the full ranked data every round's split was cut from
+    meta = load_metadata('./data/eastmoney_full_ranked.csv', coded_cols=post_cols+author_cols)
+    post_ft_unique_count = meta.unique_counts(post_cols)
+    author_ft_unique_count = meta.unique_counts(author_cols)
     post_ft_count = train_data.get_post_feature_count()
     author_ft_count = train_data.get_author_feature_count()
 
@@ -360,14 +443,26 @@ elif args.model == 'BertBpr_v3':
         author_ft_count = author_ft_count,
         device = device,
         bert = args.bert,
-        bert_freeze=False, 
+        bert_freeze=args.freeze_bert, 
         drop_rate = args.drop
     ).to(device)
     if args.round>1:
         model.load_state_dict(MODEL_PATH)
+    if args.freeze_bert:
+        # swap the title tokens of the training post tables for their cached pooler_output, so training runs the heads only
+        # (the test data keeps its tokens: eval reports title attention)
+        for bpr_data in (train_data, valid_data):
+            if bpr_data is not None:
+                bpr_data.posts = (load_title_reps(bpr_data.posts[0], model, args.batch),) + tuple(bpr_data.posts[1:])
+        # loaders again over the swapped tables, no longer length-bucketed
+        train_dataloader = make_loader(train_data, trim=True)
+        valid_dataloader = make_loader(valid_data, trim=True) if valid_data else None
+        valid_dataset = test_dataset = (valid_dataloader, test_dataloader)
 else:
     print('Invalid model choice!')
     exit()
+if args.compile:
+    compile_forward(model, args.compile_cache)
 print(f"Model created: {args.model}")
 
 # save model before exit
@@ -383,6 +478,8 @@ elif args.optim=='Adam':
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
 else: # default adamW good for transformer based
     optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr)
+# fp16 gradients underflow without loss scaling, bf16 keeps the fp32 exponent range and needs none
+scaler = torch.amp.GradScaler(device.type, enabled=args.precision=='fp16')
 
 ### Test Mode
 if args.mode=="test":
@@ -395,7 +492,8 @@ if args.mode=="test":
 
     print("-"*10 + "Start testing" + "-"*10)
     time_s = time.time()
-    test_loss, metrics, report = model.eval(test_dataset, device, explain=True)
+    with autocast():
+        test_loss, metrics, report = model.eval(test_dataset, device, explain=True)
 
     # print result
     print(f"AVG TEST LOSS: {test_loss/len(test_dataloader)}")
@@ -418,6 +516,10 @@ elif args.mode=="train":
     patience = 2
     stop_training = False
 
+    # hard negative mining state: cached candidate title representations
+    title_cache = None
+    mining_round = 0
+
     t_epoch = trange(args.epoch, leave=False)
     epoch_loss = 0
     for epoch in t_epoch:
@@ -425,6 +527,16 @@ elif args.mode=="train":
         t_epoch.set_description(f"Epoch {epoch} - avg loss: {epoch_loss/len(train_dataloader)}")
         t_epoch.refresh()
         epoch_loss = 0 #reset epoch loss for current epoch training
+        if args.hard_neg and epoch>0 and epoch%args.hard_neg==0: # combination checked at startup
+            # rescore the candidate negatives with the current model, later draws favour high-scoring (hard) ones
+            if args.hard_neg_refresh and mining_round%args.hard_neg_refresh==0:
+                title_cache = None
+            neg_ids = train_data.get_neg_candidates()
+            neg_scores, title_cache = model.score_posts(train_data.posts, neg_ids, args.batch, title_cache)
+            train_data.set_neg_scores(neg_ids, neg_scores.numpy(), args.hard_neg_temp)
+            mining_round += 1
+        if hasattr(train_data, 'set_epoch'): # fresh bpr negatives for this epoch
+            train_data.set_epoch(epoch)
         
         batch_loss = 0
         batch_tqdm = tqdm(train_dataloader, leave=False)
@@ -435,14 +547,23 @@ elif args.mode=="train":
             batch_tqdm.refresh()
             # logging.info(f"Batch {batch} - avg loss {batch_loss}\n")
             
-            batch_loss = model.train(batch_data)
+            # backpropagation, over --accum_steps micro-batches of the batch with gradients accumulated
+            optimizer.zero_grad()
+            batch_loss = 0
+            micro_batches = split_batch(batch_data, args.accum_steps) if args.accum_steps > 1 else [batch_data]
+            for micro_data in micro_batches:
+                with autocast():
+                    micro_loss = model.train(micro_data)
+                # averaged losses weighted by the micro-batch's share of rows (pairs), summed ones add up as they are:
+                # loss and gradients are the full batch's
+                if getattr(model, 'loss_reduction', 'mean') == 'mean' and len(micro_batches) > 1:
+                    micro_loss = micro_loss * batch_len(micro_data) / batch_len(batch_data)
+                scaler.scale(micro_loss).backward()
+                batch_loss += micro_loss.detach()
 
             epoch_loss += batch_loss
-
-            # backpropagation
-            optimizer.zero_grad()
-            batch_loss.backward()
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
             # torch.nn.utils.clip_grad_norm(parameters=model.parameters(), max_norm=10, norm_type=2.0)
 
             # time.sleep(0.01)
@@ -450,7 +571,8 @@ elif args.mode=="train":
         # eavluate on test data
         # if valid_dataset:
         batch_tqdm.set_description(f"Epoch {epoch} evaluation:")
-        valid_loss, metrics, report = model.eval(valid_dataset, device, explain=True)
+        with autocast():
+            valid_loss, metrics, report = model.eval(valid_dataset, device, explain=True)
         for e, val in metrics.items():
             print(f"AVG SCORE for {e}: {val}")
 
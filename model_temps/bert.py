@@ -4,7 +4,9 @@ from torch.utils.data import DataLoader
 
 from transformers import BertModel, BertConfig, BertTokenizer
 
+from model_temps.layers import FusedEmbedding
 from evaluator import R2_SCORE, ADJUST_R2, ACCURACY, RECALL, PRECISION, F1
+from model_temps.explain import attention_capture
 
 import pandas as pd
 
@@ -23,14 +25,12 @@ class Bert(nn.Module):
         # configuration.attention_probs_dropout_prob = 0.8
         # self.title_bert = BertForSequenceClassification.from_pretrained('bert-base-chinese', config=configuration)
         # tokenizer = BertTokenizer.from_pretrained('bert-base-chinese')
-        self.title_bert = BertModel.from_pretrained(bert, output_attentions=True)
+        self.title_bert = BertModel.from_pretrained(bert) # attention maps only on demand, see forward
         self.bert_linear = nn.Linear(768, dim, bias=True)
         
 
         ## cat input embedding module #'stock_code', 'item_author', 'article_author', 'article_source'\
-        self.embedding_layer = nn.ModuleList()
-        for i in range(embed_cols_count):
-            self.embedding_layer.append(nn.Embedding(cat_unique_count[i], dim))
+        self.embedding_layer = FusedEmbedding(cat_unique_count[:embed_cols_count], dim)
 
         ## num input network module #'item_views', 'item_comment_counts', 'article_likes', 'eastmoney_robo_journalism', 'media_robo_journalism', 'SMA_robo_journalism'
         self.num_feature_network = nn.Linear(num_cols_count, dim, bias=True)
@@ -42,14 +42,17 @@ class Bert(nn.Module):
         # define evaluator
         self.evaluators = [ACCURACY()] #,RECALL(),PRECISION(),F1()
 
-    def forward(self, text_input, non_text_input):
+    def forward(self, text_input, non_text_input, output_attentions=False):
         #text representation
-        title_output = self.title_bert(text_input[:,0,:], attention_mask=text_input[:,1,:]) #batch*768
+        title_output = self.title_bert(text_input[:,0,:], attention_mask=text_input[:,1,:], output_attentions=output_attentions) #batch*768
         text_rep = self.bert_linear(title_output.pooler_output) #batch*dim
         # print(title_output)
 
-        title_att_score = torch.sum(title_output.attentions[-1],dim=1) #batch*len*len
-        title_att_score = torch.sum(title_att_score,dim=1) #batch*len
+        # title attention only when asked for (explain), inside attention_capture
+        title_att_score = None
+        if output_attentions:
+            title_att_score = torch.sum(title_output.attentions[-1],dim=1) #batch*len*len
+            title_att_score = torch.sum(title_att_score,dim=1) #batch*len
         # title_att_score=0
         
         """
@@ -70,11 +73,8 @@ class Bert(nn.Module):
         # print(num_rep.shape)
 
         #cat representation
-        cat_reps = torch.zeros((non_text_input.shape[0],self.dim)).to(self.device)
-        for i in range(self.embed_cols_count):
-            single_embed_rep = self.embedding_layer[i](non_text_input[:,self.num_cols_count+i].to(torch.int))
-            cat_reps += single_embed_rep
-        cat_rep = cat_reps/self.embed_cols_count #batch*dim
+        cat_reps = self.embedding_layer(non_text_input[:,self.num_cols_count:self.num_cols_count+self.embed_cols_count]) #batch*fields*dim
+        cat_rep = cat_reps.mean(dim=1) #batch*dim
 
         # final_rep = torch.cat((text_rep, num_rep, cat_rep), dim=1) #batch*3dim
         final_rep = torch.cat((text_rep, cat_rep), dim=1)
@@ -90,7 +90,7 @@ class Bert(nn.Module):
         return loss
     
     def eval(self, eval_data:DataLoader, device, explain=True):
-        with torch.no_grad():
+        with torch.no_grad(), attention_capture(self.title_bert, explain):
             eval_loss = 0
             metrics_vals = {type(k).__name__:torch.zeros(1).to(device) for k in self.evaluators}
 
@@ -105,7 +105,7 @@ class Bert(nn.Module):
                 non_text_input = non_text_input.to(device)
                 y = y.squeeze().to(torch.long).to(device)
 
-                pred, title_att_score = self.forward(text_input, non_text_input)
+                pred, title_att_score = self.forward(text_input, non_text_input, output_attentions=explain)
 
                 eval_loss = self.compute_loss(pred, y)
 
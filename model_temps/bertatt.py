@@ -3,6 +3,8 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 
 from transformers import BertModel, BertTokenizer
+from model_temps.explain import attention_capture
+from model_temps.layers import FusedEmbedding, GroupedMLP
 from evaluator import ACCURACY, CLASSIFICATION
 
 # import numpy as np
@@ -45,7 +47,7 @@ class BertAtt(nn.Module):
         # configuration.attention_probs_dropout_prob = 0.8
         # self.title_bert = BertForSequenceClassification.from_pretrained('bert-base-chinese', config=configuration)
         self.tokenizer = BertTokenizer.from_pretrained(bert)
-        self.title_bert = BertModel.from_pretrained(bert, output_attentions=True)
+        self.title_bert = BertModel.from_pretrained(bert) # attention maps only on demand, see forward
         self.bert_linear = nn.Sequential(
             nn.Linear(768, dim*2, bias=True),
             nn.ReLU(),
@@ -54,19 +56,10 @@ class BertAtt(nn.Module):
         )
 
         ## cat input embedding module #'stock_code', 'item_author', 'article_author', 'article_source', 'eastmoney_robo_journalism', 'media_robo_journalism', 'SMA_robo_journalism'\
-        self.embedding_layer = nn.ModuleList()
-        for i in range(embed_cols_count):
-            self.embedding_layer.append(nn.Embedding(cat_unique_count[i], dim))
+        self.embedding_layer = FusedEmbedding(cat_unique_count[:embed_cols_count], dim)
 
         ## num input network module #'item_views', 'item_comment_counts', 'article_likes',
-        self.network_layer = nn.ModuleList()
-        for i in range(num_cols_count):
-            self.network_layer.append(nn.Sequential(
-            nn.Linear(1, dim//2, bias=True),
-            nn.ReLU(),
-            nn.Linear(dim//2, dim, bias=True),
-            nn.Dropout(0.1) 
-        ))
+        self.network_layer = GroupedMLP(num_cols_count, dim//2, dim, 0.1)
 
         self.topic_layer = nn.Sequential(
             nn.Linear(topic_num, dim//2, bias=True),
@@ -91,18 +84,20 @@ class BertAtt(nn.Module):
         # define evaluator
         self.evaluators = [ACCURACY(), CLASSIFICATION()]
 
-    def forward(self, text_input, non_text_input):
+    def forward(self, text_input, non_text_input, output_attentions=False):
 
         #text representation
-        title_output = self.title_bert(text_input[:,0,:], attention_mask=text_input[:,1,:]) #batch*768
+        title_output = self.title_bert(text_input[:,0,:], attention_mask=text_input[:,1,:], output_attentions=output_attentions) #batch*768
         text_rep = title_output.pooler_output #batch*768
         # text_rep = torch.flatten(text_rep, start_dim=1) #batch*(len*768)
         text_rep = self.bert_linear(text_rep).unsqueeze(1) #batch*1*dim
         # print(text_rep.shape)
 
-        #extract attention: title_output.attentions has 12 (layers) of (batch*head(12)*len*len)
-        title_att_score = torch.sum(title_output.attentions[-1],dim=1) #batch*len*len
-        title_att_score = torch.sum(title_att_score,dim=1) #batch*len
+        #extract attention: title_output.attentions has 12 (layers) of (batch*head(12)*len*len), only when asked for (explain)
+        title_att_score = None
+        if output_attentions:
+            title_att_score = torch.sum(title_output.attentions[-1],dim=1) #batch*len*len
+            title_att_score = torch.sum(title_att_score,dim=1) #batch*len
         # print(title_att_score.shape)
         
         # print(non_text_input)
@@ -130,22 +125,13 @@ class BertAtt(nn.Module):
 
         # #num representation
         if self.num_cols_count>0:
-            num_reps = torch.zeros((non_text_input.shape[0],1,self.dim)).to(self.device)
-            for i in range(self.num_cols_count):
-                # self.network_layer[i].to(self.device)
-                num_rep = self.network_layer[i](non_text_input[:,i].unsqueeze(1)) #batch*dim  
-                num_reps = torch.cat((num_reps, num_rep.unsqueeze(1)),dim=1)
-            num_reps = num_reps[:,1:,:] #batch*1*dim
+            num_reps = self.network_layer(non_text_input[:,:self.num_cols_count]) #batch*num_cols*dim
         else:
             num_reps = None
 
         #cat representation
         if self.embed_cols_count>0:
-            cat_reps = torch.zeros((non_text_input.shape[0],1,self.dim)).to(self.device)
-            for i in range(self.embed_cols_count):
-                embed_rep = self.embedding_layer[i](non_text_input[:,self.num_cols_count+i].to(torch.int)) #batch*dim
-                cat_reps = torch.cat((cat_reps, embed_rep.unsqueeze(1)),dim=1)
-            cat_reps = cat_reps[:,1:,:] #batch*9*dim
+            cat_reps = self.embedding_layer(non_text_input[:,self.num_cols_count:self.num_cols_count+self.embed_cols_count]) #batch*9*dim
             # print(cat_reps.shape)
         else:
             cat_reps = None
@@ -233,7 +219,7 @@ class BertAtt(nn.Module):
 
 
     def eval(self, eval_data:DataLoader, device, explain=False):
-        with torch.no_grad():
+        with torch.no_grad(), attention_capture(self.title_bert, explain):
             eval_loss = 0
             # metrics_vals = {type(k).__name__:torch.zeros(1).to(device) for k in self.evaluators}
             metrics_vals = {}
@@ -250,7 +236,7 @@ class BertAtt(nn.Module):
                 non_text_input = non_text_input.to(device)
                 y = y.squeeze().to(torch.long).to(device)
 
-                pred, feature_att_score, title_att_score = self.forward(text_input, non_text_input)
+                pred, feature_att_score, title_att_score = self.forward(text_input, non_text_input, output_attentions=explain)
 
                 eval_loss += self.compute_loss(pred, y)
 
@@ -1,8 +1,12 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from transformers import BertModel, BertTokenizer
+from model_temps.explain import attention_capture
+from model_temps.layers import FusedEmbedding, GroupedMLP
 from evaluator import ACCURACY, CLASSIFICATION, NDCG
+from dataset.transform import cat_batches
 
 # import numpy as np
 import pandas as pd
@@ -38,6 +42,7 @@ class BertAttBpr(nn.Module):
         self.topic_num = topic_num
         self.device = device
         self.bert = bert
+        self.loss_reduction = 'sum' # compute_loss sums over the pairs of a batch (averaged by the other models)
 
         ## text input module
         # configuration = BertConfig.from_pretrained('bert-base-chinese', output_hidden_states=True, output_attentions=True)
@@ -45,7 +50,7 @@ class BertAttBpr(nn.Module):
         # configuration.attention_probs_dropout_prob = 0.8
         # self.title_bert = BertForSequenceClassification.from_pretrained('bert-base-chinese', config=configuration)
         self.tokenizer = BertTokenizer.from_pretrained(self.bert)
-        self.title_bert = BertModel.from_pretrained(bert, output_attentions=True)
+        self.title_bert = BertModel.from_pretrained(bert) # attention maps only on demand, see forward
         self.bert_linear = nn.Sequential(
             nn.Linear(768, dim*2, bias=True),
             nn.ReLU(),
@@ -54,19 +59,10 @@ class BertAttBpr(nn.Module):
         )
 
         ## cat input embedding module #'item_author', 'article_author', 'article_source'
-        self.post_embedding_layer = nn.ModuleList()
-        for i in range(cat_cols_count):
-            self.post_embedding_layer.append(nn.Embedding(cat_unique_count[i], dim))
+        self.post_embedding_layer = FusedEmbedding(cat_unique_count[:cat_cols_count], dim)
 
         ## num input network module #'item_views', 'item_comment_counts', 'article_likes'
-        self.network_layer = nn.ModuleList()
-        for i in range(num_cols_count):
-            self.network_layer.append(nn.Sequential(
-            nn.Linear(1, dim//2, bias=True),
-            nn.ReLU(),
-            nn.Linear(dim//2, dim, bias=True),
-            nn.Dropout(0.1) 
-        ))
+        self.network_layer = GroupedMLP(num_cols_count, dim//2, dim, 0.1)
 
         self.topic_layer = nn.Sequential(
             nn.Linear(topic_num, dim//2, bias=True),
@@ -81,26 +77,26 @@ class BertAttBpr(nn.Module):
         self.task_embedding = nn.Parameter(torch.rand(1,1,dim), requires_grad=True)
 
         ## user input embedding module # 'item_author', 'article_author', 'article_source'
-        self.user_embedding_layer = nn.ModuleList()
-        for i in range(user_cols_count):
-            self.user_embedding_layer.append(nn.Embedding(user_unique_count[i], dim))
+        self.user_embedding_layer = FusedEmbedding(user_unique_count[:user_cols_count], dim)
 
         # define evaluator
         self.evaluators = [ACCURACY(), CLASSIFICATION(), NDCG(1), NDCG(5), NDCG(10), NDCG(-1)]
 
-    def forward(self, text_input, non_text_input, user_input):
+    def forward(self, text_input, non_text_input, user_input, output_attentions=False):
         ## news representation
 
         #text representation
-        title_output = self.title_bert(text_input[:,0,:], attention_mask=text_input[:,1,:]) #batch*768
+        title_output = self.title_bert(text_input[:,0,:], attention_mask=text_input[:,1,:], output_attentions=output_attentions) #batch*768
         text_rep = title_output.pooler_output #batch*768
         # text_rep = torch.flatten(text_rep, start_dim=1) #batch*(len*768)
         text_rep = self.bert_linear(text_rep).unsqueeze(1) #batch*1*dim
         # print(text_rep.shape)
 
-        #extract attention: title_output.attentions has 12 (layers) of (batch*head(12)*len*len)
-        title_att_score = torch.sum(title_output.attentions[-1],dim=1) #batch*len*len
-        title_att_score = torch.sum(title_att_score,dim=1) #batch*len
+        #extract attention: title_output.attentions has 12 (layers) of (batch*head(12)*len*len), only when asked for (explain)
+        title_att_score = None
+        if output_attentions:
+            title_att_score = torch.sum(title_output.attentions[-1],dim=1) #batch*len*len
+            title_att_score = torch.sum(title_att_score,dim=1) #batch*len
         # print(title_att_score.shape)
 
         """
@@ -115,22 +111,13 @@ class BertAttBpr(nn.Module):
 
         # #num representation
         if self.num_cols_count>0:
-            num_reps = torch.zeros((non_text_input.shape[0],1,self.dim)).to(self.device)
-            for i in range(self.num_cols_count):
-                # self.network_layer[i].to(self.device)
-                num_rep = self.network_layer[i](non_text_input[:,i].unsqueeze(1)) #batch*dim  
-                num_reps = torch.cat((num_reps, num_rep.unsqueeze(1)),dim=1)
-            num_reps = num_reps[:,1:,:] #batch*1*dim
+            num_reps = self.network_layer(non_text_input[:,:self.num_cols_count]) #batch*num_cols*dim
         else:
             num_reps = None
 
         #cat representation
         if self.cat_cols_count>0:
-            cat_reps = torch.zeros((non_text_input.shape[0],1,self.dim)).to(self.device)
-            for i in range(self.cat_cols_count):
-                embed_rep = self.post_embedding_layer[i](non_text_input[:,self.num_cols_count+i].to(torch.int)) #batch*dim
-                cat_reps = torch.cat((cat_reps, embed_rep.unsqueeze(1)),dim=1)
-            cat_reps = cat_reps[:,1:,:] #batch*6*dim
+            cat_reps = self.post_embedding_layer(non_text_input[:,self.num_cols_count:self.num_cols_count+self.cat_cols_count]) #batch*6*dim
             # print(cat_reps.shape)
         else:
             cat_reps = None
@@ -168,11 +155,7 @@ class BertAttBpr(nn.Module):
             'article_author_reduced',
             'article_source_reduced'
         """
-        user_reps = torch.zeros((user_input.shape[0],1,self.dim)).to(self.device)
-        for i in range(self.user_cols_count):
-            embed_rep = self.user_embedding_layer[i](user_input[:,i].to(torch.int)) #batch*dim
-            user_reps = torch.cat((user_reps, embed_rep.unsqueeze(1)),dim=1)
-        user_reps = user_reps[:,1:,:] #batch*9*dim
+        user_reps = self.user_embedding_layer(user_input[:,:self.user_cols_count]) #batch*9*dim
         # print(user_reps.shape)
 
         user_attentioned_rep, user_feature_att_score = self.user_attention_module(user_reps, self.task_embedding.expand(user_reps.shape[0], -1, -1))
@@ -188,28 +171,15 @@ class BertAttBpr(nn.Module):
 
         # return pos_score, p_feature_att_score, p_title_att_score, neg_score, n_feature_att_score, n_title_att_score
     
+    def forward_pair(self, pos_data, neg_data):
+        # bpr positives and negatives in one forward pass (one bert call at twice the batch), scores split back
+        text_input, non_text_input, user_input = (x.to(self.device) for x in cat_batches(pos_data, neg_data))
+        scores, _, _ = self.forward(text_input, non_text_input, user_input)
+        return scores[:len(pos_data[0])], scores[len(pos_data[0]):]
+
     def train(self, data):
         pos_data, neg_data = data
-
-        #---for pos data
-        pos_text_input, pos_non_text_input, pos_user_input = pos_data
-
-        #load data to device
-        pos_text_input = pos_text_input.to(self.device)
-        pos_non_text_input = pos_non_text_input.to(self.device)
-        pos_user_input = pos_user_input.to(self.device)
-
-        pos_scores, _, _ = self.forward(pos_text_input, pos_non_text_input, pos_user_input)
-
-        #---for neg data
-        neg_text_input, neg_non_text_input, neg_user_input = neg_data
-
-        #load data to device
-        neg_text_input = neg_text_input.to(self.device)
-        neg_non_text_input = neg_non_text_input.to(self.device)
-        neg_user_input = neg_user_input.to(self.device)
-
-        neg_scores, _, _ = self.forward(neg_text_input, neg_non_text_input, neg_user_input)
+        pos_scores, neg_scores = self.forward_pair(pos_data, neg_data)
 
         batch_loss = self.compute_loss(pos_scores, neg_scores)
             
@@ -222,7 +192,8 @@ class BertAttBpr(nn.Module):
         # Compute the BPR loss
         # print(pos_scores, neg_scores)
         # print(score_diff)
-        loss = -torch.log(torch.sigmoid(score_diff)).sum()
+        # log-sigmoid in fp32: exact for large negative differences and safe under autocast
+        loss = -F.logsigmoid(score_diff.float()).sum()
 
         # Add L2 regularization
         lambda_reg = 0
@@ -240,54 +211,36 @@ class BertAttBpr(nn.Module):
             valid_data = tqdm(valid_data, leave=False)
             valid_data.set_description("Evaluating model loss on validation set")
             for _, (pos_data, neg_data) in enumerate(valid_data):
-
-                #---for pos data
-                pos_text_input, pos_non_text_input, pos_user_input = pos_data
-
-                #load data to device
-                pos_text_input = pos_text_input.to(self.device)
-                pos_non_text_input = pos_non_text_input.to(self.device)
-                pos_user_input = pos_user_input.to(self.device)
-
-                pos_scores, _, _ = self.forward(pos_text_input, pos_non_text_input, pos_user_input)
-
-                #---for neg data
-                neg_text_input, neg_non_text_input, neg_user_input = neg_data
-
-                #load data to device
-                neg_text_input = neg_text_input.to(self.device)
-                neg_non_text_input = neg_non_text_input.to(self.device)
-                neg_user_input = neg_user_input.to(self.device)
-
-                neg_scores, _, _ = self.forward(neg_text_input, neg_non_text_input, neg_user_input)
-
+                pos_scores, neg_scores = self.forward_pair(pos_data, neg_data)
                 eval_loss += self.compute_loss(pos_scores, neg_scores)
             
 
             ## compute test metrics
             metrics_vals = {}
             total_scores, ys = torch.tensor([]), torch.tensor([])
-            total_feature_att_scores, total_title_att_scores, total_text_input = torch.tensor([]).to(device), torch.tensor([]).to(device), torch.tensor([]).to(device)
+            total_feature_att_scores, total_title_att_scores, total_text_input = torch.tensor([]).to(device), torch.tensor([]).to(device), torch.tensor([], dtype=torch.long).to(device)
 
             test_data = tqdm(test_data, leave=False)
             test_data.set_description("Testing model performance on test set")
-            for _, data in enumerate(test_data):
-                text_input, non_text_input, user_input, y = data
-                text_input = text_input.to(self.device)
-                non_text_input = non_text_input.to(self.device)
-                user_input = user_input.to(self.device)
-
-                ys = torch.cat((ys, y.cpu().detach()))
-
-                scores, feature_att_score, title_att_score = self.forward(text_input, non_text_input, user_input)
-                # Calculate the number of elements to set to 1
-                scores = scores.cpu().detach()
-
-                # record info in each batch
-                total_scores = torch.cat((total_scores, scores))
-                total_feature_att_scores = torch.cat((total_feature_att_scores, feature_att_score))
-                total_title_att_scores = torch.cat((total_title_att_scores, title_att_score))
-                total_text_input = torch.cat((total_text_input, text_input))
+            with attention_capture(self.title_bert, explain): # attention maps for the test report only
+                for _, data in enumerate(test_data):
+                    text_input, non_text_input, user_input, y = data
+                    text_input = text_input.to(self.device)
+                    non_text_input = non_text_input.to(self.device)
+                    user_input = user_input.to(self.device)
+
+                    ys = torch.cat((ys, y.cpu().detach()))
+
+                    scores, feature_att_score, title_att_score = self.forward(text_input, non_text_input, user_input, output_attentions=explain)
+                    # Calculate the number of elements to set to 1
+                    scores = scores.cpu().detach()
+
+                    # record info in each batch
+                    total_scores = torch.cat((total_scores, scores))
+                    total_feature_att_scores = torch.cat((total_feature_att_scores, feature_att_score))
+                    if explain: # title attention and tokens for the report
+                        total_title_att_scores = torch.cat((total_title_att_scores, title_att_score))
+                        total_text_input = torch.cat((total_text_input, text_input))
 
             ## label data according to score
             x_percent = 0.01
@@ -302,6 +255,7 @@ class BertAttBpr(nn.Module):
                 metrics_vals[repr(e)] = e(ys, preds) #[1, task]
                 
 
+        report = None
         if explain: #record attention scores for analysis
 
             # recover text
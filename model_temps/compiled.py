@@ -0,0 +1,20 @@
+import os
+import torch
+
+CACHE_DIR = './data/compile_cache'
+
+def compile_forward(model, cache_dir=CACHE_DIR):
+    """
+    Swaps model.forward for its torch.compile (inductor) version, so the model's own train/eval/forward_pair calls
+    run compiled. Shapes are specialized on the first batch; a batch of another size or title length (the last
+    partial batch, per-batch trimmed padding) recompiles once with those dims dynamic instead of once per shape.
+    Compiled graphs (forward and backward) and kernels are cached in cache_dir, which later runs of the same model
+    code and shapes (e.g. sweep trials) load instead of compiling again.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+    torch._inductor.config.fx_graph_cache = True
+    torch._functorch.config.enable_autograd_cache = True
+    torch._dynamo.config.automatic_dynamic_shapes = True
+    model.forward = torch.compile(model.forward, dynamic=None)
+    return model
@@ -0,0 +1,18 @@
+from contextlib import contextmanager
+
+@contextmanager
+def attention_capture(bert, enabled=True):
+    """
+    Lets `bert` return attention maps (forward with output_attentions=True) inside the block, for the explain/report
+    path of eval. Training forwards skip them and keep the fused sdpa kernel, which cannot return attention maps, so
+    the eager implementation is only switched in for the block.
+    """
+    impl = getattr(bert.config, '_attn_implementation', None)
+    switch = enabled and impl not in (None, 'eager') and hasattr(bert, 'set_attn_implementation')
+    if switch:
+        bert.set_attn_implementation('eager')
+    try:
+        yield
+    finally:
+        if switch:
+            bert.set_attn_implementation(impl)
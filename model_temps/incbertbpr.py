@@ -1,8 +1,12 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from transformers import BertModel, BertTokenizer
+from model_temps.layers import FusedEmbedding
 from evaluator import ACCURACY, CLASSIFICATION, NDCG
+from model_temps.explain import attention_capture
+from dataset.transform import trim_text, cat_batches
 
 # import numpy as np
 import pandas as pd
@@ -56,7 +60,7 @@ class IncBertAttBpr(nn.Module):
         # configuration.attention_probs_dropout_prob = 0.8
         # self.title_bert = BertForSequenceClassification.from_pretrained('bert-base-chinese', config=configuration)
         self.tokenizer = BertTokenizer.from_pretrained(self.bert)
-        self.title_bert = BertModel.from_pretrained(bert, output_attentions=True)
+        self.title_bert = BertModel.from_pretrained(bert) # attention maps only on demand, see forward
         self.bert_linear = nn.Sequential(
             nn.Linear(768, dim*2, bias=True),
             nn.LeakyReLU(),
@@ -70,13 +74,9 @@ class IncBertAttBpr(nn.Module):
                 param.requires_grad = False
 
         ## 
-        self.post_embedding_layer = nn.ModuleList()
-        for i in range(post_ft_count):
-            self.post_embedding_layer.append(nn.Embedding(post_ft_unique_count[i], dim))
-
-        self.author_embedding_layer = nn.ModuleList()
-        for i in range(author_ft_count):
-            self.author_embedding_layer.append(nn.Embedding(author_ft_unique_count[i], dim))
+        # all post / author fields in one table each, looked up in one call
+        self.post_embedding_layer = FusedEmbedding(post_ft_unique_count[:post_ft_count], dim)
+        self.author_embedding_layer = FusedEmbedding(author_ft_unique_count[:author_ft_count], dim)
 
 
         # self.author_attention_module = Attention(dim)
@@ -98,31 +98,48 @@ class IncBertAttBpr(nn.Module):
         # define evaluator
         self.evaluators = [ACCURACY(), CLASSIFICATION(), NDCG(10), NDCG(0.01), NDCG(0.05), NDCG()]
 
-    def forward(self, text_input, post_input, author_input):
+    def forward(self, text_input, post_input, author_input, output_attentions=False):
         ## post representation
 
+        if self.bert_freeze and text_input.is_floating_point():
+            # frozen bert trained from cached title representations (pooler_output, batch*768): heads only, no title attention
+            scores, feature_att_score, post_attentioned_rep, author_attentioned_rep = self.forward_head(text_input, post_input, author_input)
+            return scores, feature_att_score, None, post_attentioned_rep, author_attentioned_rep
+
         #text representation
-        title_output = self.title_bert(text_input[:,0,:], attention_mask=text_input[:,1,:]) #batch*768
-        text_rep = title_output.pooler_output #batch*768
-        # text_rep = torch.flatten(text_rep, start_dim=1) #batch*(len*768)
-        text_rep = self.bert_linear(text_rep).unsqueeze(1) #batch*1*dim
-        # print(text_rep.shape)
+        title_output = self.title_bert(text_input[:,0,:], attention_mask=text_input[:,1,:], output_attentions=output_attentions) #batch*768
 
-        #extract attention
-        attentions = title_output.attentions  # This is a tuple of attention matrices from each layer
+        # title attention only when asked for (explain), inside attention_capture
+        title_att_score = None
+        if output_attentions:
+            #extract attention
+            attentions = title_output.attentions  # This is a tuple of attention matrices from each layer
  
-        # Concatenate attentions from all layers (stack them)
-        all_layer_attentions = torch.stack(attentions, dim=0)  # Shape: [num_layers, batch_size, num_heads, seq_len, seq_len]
-        # print(all_layer_attentions.shape)
+            # Concatenate attentions from all layers (stack them)
+            all_layer_attentions = torch.stack(attentions, dim=0)  # Shape: [num_layers, batch_size, num_heads, seq_len, seq_len]
+            # print(all_layer_attentions.shape)
+
+            # Average across attention heads (shape: [num_layers, batch_size, seq_len, seq_len])
+            avg_attention_heads = all_layer_attentions.mean(dim=2)  # Shape: [num_layers, batch_size, seq_len, seq_len]
+
+            # Average across all layers (shape: [batch_size, seq_len, seq_len])
+            avg_attention_layers = avg_attention_heads.mean(dim=0)  # Shape: [batch_size, seq_len, seq_len]
 
-        # Average across attention heads (shape: [num_layers, batch_size, seq_len, seq_len])
-        avg_attention_heads = all_layer_attentions.mean(dim=2)  # Shape: [num_layers, batch_size, seq_len, seq_len]
+            # Concentrated attention score for each token is the sum of attention values across all positions
+            title_att_score = avg_attention_layers.sum(dim=1)  # Shape: [seq_len]
 
-        # Average across all layers (shape: [batch_size, seq_len, seq_len])
-        avg_attention_layers = avg_attention_heads.mean(dim=0)  # Shape: [batch_size, seq_len, seq_len]
+        scores, feature_att_score, post_attentioned_rep, author_attentioned_rep = self.forward_head(title_output.pooler_output, post_input, author_input)
 
-        # Concentrated attention score for each token is the sum of attention values across all positions
-        title_att_score = avg_attention_layers.sum(dim=1)  # Shape: [seq_len]
+        return scores, feature_att_score, title_att_score, post_attentioned_rep, author_attentioned_rep
+        # pos_score, p_feature_att_score, p_title_att_score = self.compute_score(pos_input)
+        # neg_score, n_feature_att_score, n_title_att_score = self.compute_score(neg_input)
+
+        # return pos_score, p_feature_att_score, p_title_att_score, neg_score, n_feature_att_score, n_title_att_score
+
+    def forward_head(self, text_rep, post_input, author_input):
+        # everything after bert: text_rep is the title pooler_output, batch*768
+        text_rep = self.bert_linear(text_rep).unsqueeze(1) #batch*1*dim
+        # print(text_rep.shape)
 
         """
         non_text post feature:
@@ -134,15 +151,7 @@ class IncBertAttBpr(nn.Module):
         """
 
         #post feature representation
-        # Initialize an empty list to store embeddings
-        non_text_reps = []
-        post_input = post_input.long()
-        # Iterate over the inputs and corresponding embedding layers
-        for i in range(self.post_ft_count):
-            # Apply the embedding layer to the input
-            embed_rep = self.post_embedding_layer[i](post_input[:, i])  # shape: (batch_size, dim)
-            non_text_reps.append(embed_rep)
-        non_text_reps = torch.stack(non_text_reps, dim=1) #batch*5*dim
+        non_text_reps = self.post_embedding_layer(post_input[:, :self.post_ft_count]) #batch*5*dim
 
         post_reps = torch.cat([text_rep, non_text_reps], dim=1) #batch*6*dim
 
@@ -150,7 +159,7 @@ class IncBertAttBpr(nn.Module):
         # post_attentioned_rep, post_feature_att_score = self.post_attention_module(post_reps, self.task_embedding.expand(post_reps.shape[0], -1, -1))
         post_attentioned_rep, post_feature_att_score = self.post_attention_module(post_reps, post_reps, post_reps)
         post_attentioned_rep, post_feature_att_score = post_attentioned_rep.mean(dim=1), post_feature_att_score.mean(dim=1)
-        post_attentioned_rep = self.post_dropout(post_attentioned_rep.squeeze())
+        post_attentioned_rep = self.post_dropout(post_attentioned_rep)
         # print(self.task_embedding)
         # print(attentioned_rep.shape)
 
@@ -164,20 +173,13 @@ class IncBertAttBpr(nn.Module):
             'article_source_index_rank'
         """
 
-        author_reps = []
-        author_input = author_input.long()
-        # Iterate over the inputs and corresponding embedding layers
-        for i in range(self.author_ft_count):
-            # Apply the embedding layer to the input
-            embed_rep = self.author_embedding_layer[i](author_input[:, i])  # shape: (batch_size, dim)
-            author_reps.append(embed_rep)
-        author_reps = torch.stack(author_reps, dim=1) #batch*6*dim
+        author_reps = self.author_embedding_layer(author_input[:, :self.author_ft_count]) #batch*6*dim
         # print(author_reps.shape)
 
         # author_attentioned_rep, author_feature_att_score = self.author_attention_module(author_reps, self.task_embedding.expand(author_reps.shape[0], -1, -1))
         author_attentioned_rep, author_feature_att_score = self.author_attention_module(author_reps, author_reps, author_reps)
         author_attentioned_rep, author_feature_att_score = author_attentioned_rep.mean(dim=1), author_feature_att_score.mean(dim=1)
-        author_attentioned_rep = self.author_dropout(author_attentioned_rep.squeeze())
+        author_attentioned_rep = self.author_dropout(author_attentioned_rep)
 
         # scores = torch.sigmoid(torch.bmm(post_attentioned_rep, author_attentioned_rep.transpose(1, 2)).squeeze())
         scores = torch.sum(post_attentioned_rep * author_attentioned_rep, dim=1)
@@ -185,36 +187,66 @@ class IncBertAttBpr(nn.Module):
         feature_att_score = torch.cat((post_feature_att_score, author_feature_att_score), dim=1)
         # print(feature_att_score.shape)
 
-        return scores, feature_att_score, title_att_score, post_attentioned_rep, author_attentioned_rep
-        # pos_score, p_feature_att_score, p_title_att_score = self.compute_score(pos_input)
-        # neg_score, n_feature_att_score, n_title_att_score = self.compute_score(neg_input)
+        return scores, feature_att_score, post_attentioned_rep, author_attentioned_rep
 
-        # return pos_score, p_feature_att_score, p_title_att_score, neg_score, n_feature_att_score, n_title_att_score
+    def encode_titles(self, text, batch_size=256):
+        """
+        pooler_output (n*768) of the titles text (n*2*len), dropout off. Titles of similar length share a batch,
+        padding trimmed.
+        """
+        reps = torch.zeros(len(text), self.title_bert.config.hidden_size)
+        was_training = self.training
+        nn.Module.train(self, False)
+        with torch.no_grad():
+            order = torch.argsort(text[:, 1].sum(dim=1))
+            for i in tqdm(range(0, len(order), batch_size), leave=False, desc="Encoding titles"):
+                batch_ids = order[i:i+batch_size]
+                text_input = trim_text(text[batch_ids]).to(self.device)
+                reps[batch_ids] = self.title_bert(text_input[:,0,:], attention_mask=text_input[:,1,:]).pooler_output.float().cpu()
+        nn.Module.train(self, was_training)
+        return reps
+
+    def score_posts(self, posts, post_ids, batch_size=256, title_cache=None):
+        """
+        Score rows post_ids of a post table (text, post, author) with the current model, dropout off.
+        title_cache = (reps, cached) holds pooler_output per post, so bert only runs on titles not cached yet.
+        returns the scores and the updated title_cache
+        """
+        text, post, author = posts
+        if text.is_floating_point(): # frozen bert: the table already holds the title representations
+            title_cache = (text, torch.ones(len(text), dtype=torch.bool))
+        elif title_cache is None:
+            title_cache = (torch.zeros(len(text), self.title_bert.config.hidden_size), torch.zeros(len(text), dtype=torch.bool))
+        reps, cached = title_cache
+        post_ids = torch.as_tensor(post_ids, dtype=torch.long)
+
+        todo = post_ids[~cached[post_ids]]
+        if len(todo):
+            reps[todo] = self.encode_titles(text[todo], batch_size)
+            cached[todo] = True
+
+        was_training = self.training
+        nn.Module.train(self, False)
+        scores = torch.zeros(len(post_ids))
+        with torch.no_grad():
+            for i in range(0, len(post_ids), batch_size):
+                batch_ids = post_ids[i:i+batch_size]
+                batch_scores, _, _, _ = self.forward_head(reps[batch_ids].to(self.device), post[batch_ids].to(self.device), author[batch_ids].to(self.device))
+                scores[i:i+batch_size] = batch_scores.float().cpu()
+        nn.Module.train(self, was_training)
+
+        return scores, (reps, cached)
     
+    def forward_pair(self, pos_data, neg_data):
+        # bpr positives and negatives in one forward pass (one bert call at twice the batch), scores split back
+        text_input, post_input, author_input = (x.to(self.device) for x in cat_batches(pos_data, neg_data))
+        scores, _, _, _, _ = self.forward(text_input, post_input, author_input)
+        return scores[:len(pos_data[0])], scores[len(pos_data[0]):]
+
     def train(self, data):
         pos_data, neg_data = data
+        pos_scores, neg_scores = self.forward_pair(pos_data, neg_data)
 
-        #---for pos data
-        pos_text_input, pos_non_text_input, pos_author_input = pos_data
-
-        #load data to device
-        pos_text_input = pos_text_input.to(self.device)
-        pos_non_text_input = pos_non_text_input.to(self.device)
-        pos_author_input = pos_author_input.to(self.device)
-
-        pos_scores, _, _, pos_post_embed, pos_author_embed = self.forward(pos_text_input, pos_non_text_input, pos_author_input)
-
-        #---for neg data
-        neg_text_input, neg_non_text_input, neg_author_input = neg_data
-
-        #load data to device
-        neg_text_input = neg_text_input.to(self.device)
-        neg_non_text_input = neg_non_text_input.to(self.device)
-        neg_author_input = neg_author_input.to(self.device)
-
-        neg_scores, _, _, neg_post_embed, neg_author_embed = self.forward(neg_text_input, neg_non_text_input, neg_author_input)
-
-        # batch_loss = self.compute_loss(pos_scores, neg_scores, (pos_post_embed, pos_author_embed, neg_post_embed, neg_author_embed))
         batch_loss = self.compute_loss(pos_scores, neg_scores)
             
         return batch_loss
@@ -226,7 +258,8 @@ class IncBertAttBpr(nn.Module):
         # Compute the BPR loss
         # print(pos_scores, neg_scores)
         # print(score_diff)
-        loss = -torch.log(torch.sigmoid(score_diff) + 1e-10).mean()
+        # log-sigmoid in fp32: no log(0) for large negative differences and safe under autocast
+        loss = -F.logsigmoid(score_diff.float()).mean()
 
         if embeddings:
             lambda_reg = 0.01
@@ -243,7 +276,6 @@ class IncBertAttBpr(nn.Module):
 
     def eval(self, eval_dataset, device, explain=False):
         valid_data, test_data = eval_dataset
-        test_len = len(test_data.dataset)
 
         with torch.no_grad():
             if valid_data:
@@ -252,56 +284,39 @@ class IncBertAttBpr(nn.Module):
                 valid_data = tqdm(valid_data, leave=False)
                 valid_data.set_description("Evaluating model loss on validation set")
                 for _, (pos_data, neg_data) in enumerate(valid_data):
-
-                    #---for pos data
-                    pos_text_input, pos_non_text_input, pos_author_input = pos_data
-
-                    #load data to device
-                    pos_text_input = pos_text_input.to(self.device)
-                    pos_non_text_input = pos_non_text_input.to(self.device)
-                    pos_author_input = pos_author_input.to(self.device)
-
-                    pos_scores, _, _, _, _ = self.forward(pos_text_input, pos_non_text_input, pos_author_input)
-
-                    #---for neg data
-                    neg_text_input, neg_non_text_input, neg_author_input = neg_data
-
-                    #load data to device
-                    neg_text_input = neg_text_input.to(self.device)
-                    neg_non_text_input = neg_non_text_input.to(self.device)
-                    neg_author_input = neg_author_input.to(self.device)
-
-                    neg_scores, _, _, _, _ = self.forward(neg_text_input, neg_non_text_input, neg_author_input)
-
+                    pos_scores, neg_scores = self.forward_pair(pos_data, neg_data)
                     eval_loss += self.compute_loss(pos_scores, neg_scores)
             
 
             ## compute test metrics
             metrics_vals = {}
             total_scores, ys = torch.tensor([]), torch.tensor([])
-            total_feature_att_scores, total_title_att_scores, total_text_input = torch.tensor([]).to(device), torch.tensor([]).to(device), torch.tensor([]).to(device)
+            total_feature_att_scores, total_title_att_scores, total_text_input = torch.tensor([]).to(device), torch.tensor([]).to(device), torch.tensor([], dtype=torch.long).to(device)
 
             test_data = tqdm(test_data, leave=False)
             test_data.set_description("Testing model performance on test set")
-            for _, data in enumerate(test_data):
-                text_input, non_text_input, user_input, y = data
-                text_input = text_input.to(self.device)
-                non_text_input = non_text_input.to(self.device)
-                user_input = user_input.to(self.device)
-
-                ys = torch.cat((ys, y.cpu().detach()))
-
-                scores, feature_att_score, title_att_score, _, _ = self.forward(text_input, non_text_input, user_input)
-                # Calculate the number of elements to set to 1
-                scores = scores.cpu().detach()
-
-                # record info in each batch
-                total_scores = torch.cat((total_scores, scores))
-                total_feature_att_scores = torch.cat((total_feature_att_scores, feature_att_score))
-                total_title_att_scores = torch.cat((total_title_att_scores, title_att_score))
-                total_text_input = torch.cat((total_text_input, text_input))
+            with attention_capture(self.title_bert, explain): # attention maps for the test report only
+                for _, data in enumerate(test_data):
+                    text_input, non_text_input, user_input, y = data
+                    text_input = text_input.to(self.device)
+                    non_text_input = non_text_input.to(self.device)
+                    user_input = user_input.to(self.device)
+
+                    ys = torch.cat((ys, y.cpu().detach()))
+
+                    scores, feature_att_score, title_att_score, _, _ = self.forward(text_input, non_text_input, user_input, output_attentions=explain)
+                    # Calculate the number of elements to set to 1
+                    scores = scores.cpu().detach()
+
+                    # record info in each batch
+                    total_scores = torch.cat((total_scores, scores))
+                    total_feature_att_scores = torch.cat((total_feature_att_scores, feature_att_score))
+                    if explain: # title attention and tokens for the report
+                        total_title_att_scores = torch.cat((total_title_att_scores, title_att_score))
+                        total_text_input = torch.cat((total_text_input, text_input))
 
             ## label data according to score
+            test_len = len(ys) # rows actually scored, streamed test data has no .dataset length
             x_percent = 0.01
             num_ones = int(ys.shape[0] * x_percent)
             # Sort the tensor in descending order
@@ -314,6 +329,7 @@ class IncBertAttBpr(nn.Module):
                 metrics_vals[repr(e)] = e(ys, preds, test_len) #[1, task]
                 
 
+        report = None
         if explain: #record attention scores for analysis
 
             # recover text
@@ -0,0 +1,74 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+class FusedEmbedding(nn.Module):
+    """
+    One embedding table for several categorical fields: field i owns rows offsets[i]..offsets[i]+unique_counts[i]-1,
+    so a batch*fields code matrix is looked up in one call, giving batch*fields*dim. Codes must be in
+    0..unique_counts[i]-1, as for nn.Embedding.
+    Same initialization as one nn.Embedding per field, and checkpoints saved with those (a ModuleList at the same
+    attribute, keys <name>.<i>.weight) load through convert_state_dict.
+    """
+    def __init__(self, unique_counts, dim):
+        super(FusedEmbedding, self).__init__()
+        self.unique_counts = list(unique_counts)
+        self.weight = nn.Parameter(torch.empty(sum(self.unique_counts), dim))
+        nn.init.normal_(self.weight)
+        offsets = torch.zeros(len(self.unique_counts), dtype=torch.long)
+        offsets[1:] = torch.cumsum(torch.tensor(self.unique_counts[:-1], dtype=torch.long), dim=0)
+        self.register_buffer('offsets', offsets, persistent=False)
+        self.register_buffer('counts', torch.tensor(self.unique_counts, dtype=torch.long), persistent=False)
+        self._register_load_state_dict_pre_hook(self.convert_state_dict, with_module=False)
+
+    def forward(self, codes):
+        # codes: batch*fields, integer codes (any numeric dtype)
+        codes = codes.long()
+        # an out-of-range code would silently read the next field's rows, where a per-field nn.Embedding raised.
+        # Checked unless python runs with -O (the check syncs with the device) or the forward is being compiled
+        if __debug__ and not torch.compiler.is_compiling() and not ((codes >= 0) & (codes < self.counts)).all():
+            field = int(((codes < 0) | (codes >= self.counts)).any(dim=0).nonzero()[0])
+            raise IndexError(f"code out of range in field {field}: unique count {self.unique_counts[field]}")
+        return F.embedding(codes + self.offsets, self.weight)
+
+    def convert_state_dict(self, state_dict, prefix, *args):
+        # per-field tables of the former nn.ModuleList of nn.Embedding -> the fused table, in field order
+        legacy = [f'{prefix}{i}.weight' for i in range(len(self.unique_counts))]
+        if legacy and all(k in state_dict for k in legacy):
+            state_dict[f'{prefix}weight'] = torch.cat([state_dict.pop(k) for k in legacy], dim=0)
+
+class GroupedMLP(nn.Module):
+    """
+    Per-column networks Linear(1, hidden) -> ReLU -> Linear(hidden, dim) -> Dropout for `groups` numeric columns,
+    each with its own weights, evaluated together: batch*groups in, batch*groups*dim out, the second layer as one
+    batched matmul over the columns.
+    Same initialization as one nn.Linear per layer and column, and checkpoints saved with the former nn.ModuleList of
+    nn.Sequential (keys <name>.<i>.0.weight, <name>.<i>.2.bias, ...) load through convert_state_dict.
+    """
+    def __init__(self, groups, hidden, dim, drop_rate=0.1):
+        super(GroupedMLP, self).__init__()
+        self.groups = groups
+        # Linear(1, hidden) and Linear(hidden, dim) of column i are weight1[i], bias1[i] and weight2[i], bias2[i]
+        self.weight1 = nn.Parameter(torch.empty(groups, hidden).uniform_(-1, 1))
+        self.bias1 = nn.Parameter(torch.empty(groups, hidden).uniform_(-1, 1))
+        bound = 1 / hidden**0.5
+        self.weight2 = nn.Parameter(torch.empty(groups, dim, hidden).uniform_(-bound, bound))
+        self.bias2 = nn.Parameter(torch.empty(groups, dim).uniform_(-bound, bound))
+        self.dropout = nn.Dropout(drop_rate)
+        self._register_load_state_dict_pre_hook(self.convert_state_dict, with_module=False)
+
+    def forward(self, x):
+        # x: batch*groups, one value per column
+        hidden = F.relu(x.unsqueeze(-1) * self.weight1 + self.bias1) #batch*groups*hidden
+        out = torch.baddbmm(self.bias2.unsqueeze(1), hidden.transpose(0, 1), self.weight2.transpose(1, 2)) #groups*batch*dim
+        return self.dropout(out.transpose(0, 1)) #batch*groups*dim
+
+    def convert_state_dict(self, state_dict, prefix, *args):
+        # per-column nn.Sequential(Linear, ReLU, Linear, Dropout) of the former nn.ModuleList -> stacked weights
+        legacy = {'weight1': ('0.weight', lambda w: w.squeeze(1)), 'bias1': ('0.bias', None),
+                  'weight2': ('2.weight', None), 'bias2': ('2.bias', None)}
+        keys = [f'{prefix}{i}.{name}' for i in range(self.groups) for name, _ in legacy.values()]
+        if self.groups and all(k in state_dict for k in keys):
+            for param, (name, reshape) in legacy.items():
+                tensors = [state_dict.pop(f'{prefix}{i}.{name}') for i in range(self.groups)]
+                state_dict[f'{prefix}{param}'] = torch.stack([reshape(t) if reshape else t for t in tensors], dim=0)
@@ -0,0 +1,47 @@
+import numpy as np
+
+from dataset.negsampler import segment_cum_weights, weighted_slots, draw_negatives
+
+
+def low_segment_after_high_pool():
+    # 200k candidates at score 40 (one positive's segment), then a 50-candidate segment scored 0-5
+    scores = np.concatenate([np.full(200000, 40.), np.linspace(0., 5., 50)])
+    start = np.array([0, 200000])
+    count = np.array([200000, 50])
+    return scores, start, count
+
+
+def test_low_scoring_segment_draws_by_its_own_scores():
+    scores, start, count = low_segment_after_high_pool()
+    cum_weight = segment_cum_weights(scores, start, count)
+    rng = np.random.default_rng(0)
+    n = 200000
+    slots = weighted_slots(np.full(n, start[1]), np.full(n, count[1]), rng.random(n), cum_weight)
+
+    assert slots.min() >= start[1] and slots.max() < start[1] + count[1]
+    freq = np.bincount(slots - start[1], minlength=count[1]) / n
+    expected = np.exp(scores[start[1]:] - scores[start[1]:].max())
+    expected /= expected.sum()
+    assert np.abs(freq - expected).sum() < 0.02 # total variation
+    assert (freq > 0).sum() > 40 # not collapsed onto the last candidate
+
+
+def test_high_scoring_segment_is_uniform():
+    scores, start, count = low_segment_after_high_pool()
+    cum_weight = segment_cum_weights(scores, start, count)
+    rng = np.random.default_rng(1)
+    slots = weighted_slots(np.zeros(100000, dtype=np.int64), np.full(100000, count[0]), rng.random(100000), cum_weight)
+    assert slots.max() < start[1]
+    # equal scores: every tenth of the segment gets a tenth of the draws
+    freq = np.bincount(slots // 20000, minlength=10) / len(slots)
+    assert np.abs(freq - 0.1).max() < 0.01
+
+
+def test_draw_negatives_stays_in_segment():
+    scores, start, count = low_segment_after_high_pool()
+    cum_weight = segment_cum_weights(scores, start, count)
+    pos, slot = draw_negatives(start, count, 10, np.random.default_rng(2), cum_weight)
+    assert np.array_equal(pos, np.repeat([0, 1], 10))
+    assert np.all((slot >= start[pos]) & (slot < start[pos] + count[pos]))
+    # the top-scored candidates of the low segment dominate its draws, instead of one fixed index
+    assert len(np.unique(slot[pos == 1])) > 1